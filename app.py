@@ -1,18 +1,232 @@
-from flask import Flask, jsonify, abort, send_from_directory, request
+from flask import Flask, Response, jsonify, abort, make_response, send_from_directory, request
 from flask_cors import CORS
 import re
+import math
 import json
+import hashlib
+import hmac
 from web3 import Web3
+from eth_abi import decode_abi
+from hexbytes import HexBytes
 import requests
+import urllib3
 import time
 import logging
 import os
-from werkzeug.exceptions import HTTPException
+import threading
+import queue
+import random
+import sqlite3
+import signal
+import uuid
+from collections import deque, namedtuple, OrderedDict
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from werkzeug.exceptions import HTTPException, BadRequest, NotFound, ServiceUnavailable
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from web3.exceptions import ContractLogicError
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 app = Flask(__name__)
 CORS(app)
 
+# Defaults for the per-chain RPC client settings; each entry in supportedConsensus.json
+# can override them with "rpcPoolSize" and "rpcTimeout" (seconds).
+DEFAULT_RPC_POOL_SIZE = 10
+DEFAULT_RPC_TIMEOUT = 10
+# Maximum number of eth_calls per JSON-RPC batch request ("rpcBatchSize")
+DEFAULT_RPC_BATCH_SIZE = 100
+
+# Circuit breaker settings of the RPC endpoints: a breaker opens after
+# BREAKER_FAILURE_THRESHOLD consecutive failures, or when the error rate over the last
+# HEALTH_WINDOW calls reaches BREAKER_ERROR_RATE, and stays open for a jittered
+# exponential backoff between BREAKER_BASE_BACKOFF and BREAKER_MAX_BACKOFF seconds.
+HEALTH_WINDOW = 20
+LATENCY_SMOOTHING = 0.3
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_ERROR_RATE = 0.5
+BREAKER_BASE_BACKOFF = 1.0
+BREAKER_MAX_BACKOFF = 60.0
+# Seconds added per unit of error rate to the latency of an IPFS gateway when ordering them
+FAILURE_PENALTY = 1.0
+
+# Requests to each RPC URL and IPFS gateway can be limited to a rate ("rpcRateLimit" of the
+# chain entry, "rateLimit" of the gateway entry, in requests per second, with bursts of
+# "rpcRateBurst"/"rateBurst") and to a number of requests in flight ("rpcMaxInFlight",
+# "maxInFlight"). An upstream over its limits is skipped like one with an open breaker.
+#
+# Lookups missing a cache go through an admission queue: at most LOOKUP_MAX_CONCURRENCY
+# run at once and up to LOOKUP_QUEUE_SIZE wait for LOOKUP_QUEUE_TIMEOUT seconds at most.
+# Beyond that, and when every upstream is over its limits, the gateway answers 503 with a
+# Retry-After of at least LOOKUP_RETRY_AFTER seconds. Cache hits never wait in the queue.
+# A lookup waiting in the queue of the Flask app still holds its worker thread, so that
+# queue only has room for LOOKUP_THREAD_QUEUE_SIZE; LOOKUP_QUEUE_SIZE sizes the queue of
+# the asyncio entry point, where waiting is cheap.
+LOOKUP_MAX_CONCURRENCY = int(os.environ.get('LOOKUP_MAX_CONCURRENCY', 64))
+LOOKUP_QUEUE_SIZE = int(os.environ.get('LOOKUP_QUEUE_SIZE', 256))
+LOOKUP_THREAD_QUEUE_SIZE = int(os.environ.get('LOOKUP_THREAD_QUEUE_SIZE', 16))
+LOOKUP_QUEUE_TIMEOUT = float(os.environ.get('LOOKUP_QUEUE_TIMEOUT', 5))
+LOOKUP_RETRY_AFTER = 1
+
+# IPFS gateways are raced: the next gateway is fired if the previous ones have not answered
+# within the hedge delay, which is the gateway's observed p95 latency once
+# HEDGE_MIN_SAMPLES are known, otherwise its "hedgeDelay" or DEFAULT_IPFS_HEDGE_DELAY.
+# Every gateway can also set its own "timeout" in supportedIPFSGateways.json.
+DEFAULT_IPFS_GATEWAY_TIMEOUT = 10
+DEFAULT_IPFS_HEDGE_DELAY = 0.5
+HEDGE_MIN_SAMPLES = 5
+IPFS_FETCH_WORKERS = 32
+
+# IPFS content is immutable, so it is cached by CID without expiry: in memory, and in an
+# SQLite file shared by every worker on the host. An empty IPFS_CACHE_PATH disables the
+# disk tier.
+IPFS_CACHE_PATH = os.environ.get('IPFS_CACHE_PATH', 'ipfsCache.sqlite')
+IPFS_CACHE_MAX_ENTRIES = int(os.environ.get('IPFS_CACHE_MAX_ENTRIES', 10000))
+IPFS_CACHE_MAX_BYTES = int(os.environ.get('IPFS_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+IPFS_CACHE_DISK_MAX_ENTRIES = int(os.environ.get('IPFS_CACHE_DISK_MAX_ENTRIES', 1000000))
+IPFS_CACHE_DISK_MAX_BYTES = int(os.environ.get('IPFS_CACHE_DISK_MAX_BYTES', 1024 * 1024 * 1024))
+# Once over a limit, the disk tier evicts down to IPFS_CACHE_DISK_EVICTION_TARGET of it in
+# one go. The access time of a disk entry, which orders the evictions, is refreshed on a hit
+# only when older than IPFS_CACHE_DISK_ACCESS_RESOLUTION seconds, so reads rarely write.
+IPFS_CACHE_DISK_EVICTION_TARGET = 0.95
+IPFS_CACHE_DISK_ACCESS_RESOLUTION = 300
+
+# Resolved tokenURIs are cached per chain entry for "tokenUriTtl" seconds, then served stale
+# for up to "tokenUriStaleTtl" seconds while they are refreshed in the background; tokens that
+# do not exist are cached for "tokenUriNegativeTtl" seconds. Set TOKEN_URI_CACHE_REDIS_URL to
+# share the cache between workers through a Redis-compatible server.
+DEFAULT_TOKEN_URI_TTL = 300
+DEFAULT_TOKEN_URI_STALE_TTL = 3600
+DEFAULT_TOKEN_URI_NEGATIVE_TTL = 30
+TOKEN_URI_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_URI_CACHE_MAX_ENTRIES', 100000))
+TOKEN_URI_CACHE_REDIS_URL = os.environ.get('TOKEN_URI_CACHE_REDIS_URL', '')
+TOKEN_URI_REFRESH_WORKERS = 4
+
+# POST /batch accepts at most BATCH_MAX_ITEMS locations and fetches their content with
+# BATCH_CONTENT_WORKERS threads
+BATCH_MAX_ITEMS = 10000
+BATCH_CONTENT_WORKERS = 16
+
+# Warm-up jobs resolve the tokenURIs of WARMUP_CHUNK_SIZE tokens at a time and fetch their
+# IPFS content with "concurrency" requests in flight, paced to "rpcRate" eth_calls and
+# "contentRate" fetches per second. Transfer logs are scanned WARMUP_LOG_BLOCK_RANGE blocks
+# at a time. A job warms at most WARMUP_MAX_TOKENS tokens, its settings are clamped to the
+# WARMUP_MAX_* maxima and at most WARMUP_MAX_RUNNING_JOBS jobs run at once. The last
+# WARMUP_MAX_JOBS jobs are kept for progress reports.
+WARMUP_MAX_TOKENS = int(os.environ.get('WARMUP_MAX_TOKENS', 10000))
+WARMUP_CHUNK_SIZE = 100
+WARMUP_DEFAULT_CONCURRENCY = 8
+WARMUP_DEFAULT_RPC_RATE = 200
+WARMUP_DEFAULT_CONTENT_RATE = 50
+WARMUP_MAX_CONCURRENCY = int(os.environ.get('WARMUP_MAX_CONCURRENCY', 16))
+WARMUP_MAX_RPC_RATE = float(os.environ.get('WARMUP_MAX_RPC_RATE', 500))
+WARMUP_MAX_CONTENT_RATE = float(os.environ.get('WARMUP_MAX_CONTENT_RATE', 100))
+WARMUP_MAX_RUNNING_JOBS = int(os.environ.get('WARMUP_MAX_RUNNING_JOBS', 2))
+WARMUP_LOG_BLOCK_RANGE = 2000
+WARMUP_MAX_JOBS = 20
+TRANSFER_EVENT_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+# The /admin endpoints are disabled (404) unless ADMIN_TOKEN is set, and then require
+# "Authorization: Bearer <ADMIN_TOKEN>"
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# With STREAM_PROXY=1, URL and IPFS content is forwarded in chunks of PROXY_CHUNK_SIZE bytes
+# as it arrives instead of being buffered. Bodies larger than MAX_PROXY_BODY_SIZE are refused.
+STREAM_PROXY = os.environ.get('STREAM_PROXY', '0') == '1'
+MAX_PROXY_BODY_SIZE = int(os.environ.get('MAX_PROXY_BODY_SIZE', 10 * 1024 * 1024))
+PROXY_CHUNK_SIZE = 64 * 1024
+URL_FETCH_TIMEOUT = 10
+PASSTHROUGH_HEADERS = ('Content-Type', 'Content-Length', 'Cache-Control', 'ETag', 'Last-Modified', 'Expires')
+
+# Cache-Control of the lookup responses per kind of token URI. A chain entry can override
+# them with a "cacheControl" object having any of these keys.
+DEFAULT_CACHE_CONTROL = {
+    "ipfs": "public, max-age=60, s-maxage=300",
+    "url": "public, max-age=60, s-maxage=60",
+    "raw": "public, max-age=60, s-maxage=300",
+}
+
+# The configuration files are checked for changes at most every CONFIG_CHECK_INTERVAL seconds
+CONFIG_CHECK_INTERVAL = 5
+
+NUMBER = (int, float)
+CONSENSUS_SCHEMA = {
+    "Name": (str, False),
+    "GlobalConsensus": (str, True),
+    "Parachain": (str, True),
+    "PalletInstance": (str, True),
+    "ChainId": (str, True),
+    "rpc": (list, True),
+    "rpcPoolSize": (int, False),
+    "rpcTimeout": (NUMBER, False),
+    "rpcBatchSize": (int, False),
+    "rpcRateLimit": (NUMBER, False),
+    "rpcRateBurst": (NUMBER, False),
+    "rpcMaxInFlight": (int, False),
+    "tokenUriTtl": (NUMBER, False),
+    "tokenUriStaleTtl": (NUMBER, False),
+    "tokenUriNegativeTtl": (NUMBER, False),
+    "cacheControl": (dict, False),
+}
+IPFS_GATEWAY_SCHEMA = {
+    "url": (str, True),
+    "apiKeySuffix": (str, True),
+    "timeout": (NUMBER, False),
+    "hedgeDelay": (NUMBER, False),
+    "maxConcurrency": (int, False),
+    "rateLimit": (NUMBER, False),
+    "rateBurst": (NUMBER, False),
+    "maxInFlight": (int, False),
+}
+
+# Set SERVER_TIMING=1 to break down the duration of every lookup in a Server-Timing header
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# Prometheus metrics served on /metrics. Chains are labeled by their "Name", RPC endpoints
+# and IPFS gateways by their host so that API keys in URLs are not exposed.
+STAGE_SECONDS = Histogram(
+    'gateway_stage_duration_seconds', 'Duration of the stages of a lookup.', ['stage', 'chain'])
+RPC_CALL_SECONDS = Histogram(
+    'gateway_rpc_call_duration_seconds', 'Duration of the tokenURI calls per RPC endpoint.', ['chain', 'endpoint'])
+IPFS_FETCH_SECONDS = Histogram(
+    'gateway_ipfs_fetch_duration_seconds', 'Duration of the fetches per IPFS gateway.', ['gateway'])
+HTTP_FETCH_SECONDS = Histogram(
+    'gateway_http_fetch_duration_seconds', 'Duration of the fetches of URL token URIs.')
+RPC_RETRIES = Counter(
+    'gateway_rpc_retries_total', 'tokenURI calls retried on another RPC endpoint.', ['chain'])
+TOKEN_URI_CACHE_LOOKUPS = Counter(
+    'gateway_token_uri_cache_lookups_total', 'tokenURI cache lookups by result.', ['chain', 'result'])
+IPFS_CACHE_LOOKUPS = Counter(
+    'gateway_ipfs_cache_lookups_total', 'IPFS cache lookups by result.', ['result'])
+UPSTREAM_RESPONSES = Counter(
+    'gateway_upstream_responses_total', 'Answers of the RPC endpoints, IPFS gateways and URL hosts by status.',
+    ['upstream', 'status'])
+UPSTREAM_THROTTLED = Counter(
+    'gateway_upstream_throttled_total', 'Requests not sent to an upstream over its rate limit or in-flight cap.',
+    ['upstream', 'host'])
+SINGLE_FLIGHT_CALLS = Counter(
+    'gateway_single_flight_calls_total', 'Upstream calls executed, or coalesced into one already in flight.',
+    ['flight', 'outcome'])
+LOOKUPS_SHED = Counter(
+    'gateway_lookups_shed_total', 'Lookups answered with 503 by an admission queue, by queue and reason.',
+    ['queue', 'reason'])
+ADMISSION_QUEUE_LOOKUPS = Gauge(
+    'gateway_admission_queue_lookups', 'Lookups holding a slot of an admission queue or waiting for one.',
+    ['queue', 'state'])
+
+TOKEN_URI_ABI = [
+    {
+        "constant": True,
+        "inputs": [{"name": "_tokenId", "type": "uint256"}],
+        "name": "tokenURI",
+        "outputs": [{"name": "", "type": "string"}],
+        "payable": False,
+        "stateMutability": "view",
+        "type": "function",
+    },
+]
+
 def load_supported_consensus():
     with open('supportedConsensus.json', 'r') as config_file:
         return json.load(config_file)
@@ -30,49 +244,273 @@ def load_supported_ipfs_gateways():
 
     return ipfs_gateways_private + ipfs_gateways
 
-# General function to extract content within parentheses after a specific keyword
-def extract_between_parentheses(keyword, path_segments):
+def validate_settings(entry, schema, name):
     """
-    Extract content within parentheses that comes immediately after a specific keyword.
+    Check the keys of a configuration entry against a schema.
 
-    :param keyword: The keyword to search for.
-    :param path_segments: List of path segments from the URL.
-    :return: Content within parentheses after the keyword if found, else None.
+    :param entry: The configuration entry.
+    :param schema: A dict of key -> (expected type or tuple of types, required).
+    :param name: How to refer to the entry in error messages.
+    :raises ValueError: If the entry does not match the schema.
     """
-    # Create a regular expression pattern that looks for the keyword followed by content within parentheses
-    pattern = rf"{keyword}\((.*?)\)"
-    for segment in path_segments:
-        match = re.search(pattern, segment)
-        if match:
-            return match.group(1)  # Return the content within parentheses
-    return None
+    if not isinstance(entry, dict):
+        raise ValueError(f"{name} must be an object")
+    for key, (expected_type, required) in schema.items():
+        if key not in entry:
+            if required:
+                raise ValueError(f"{name} is missing '{key}'")
+            continue
+        value = entry[key]
+        if not isinstance(value, expected_type) or isinstance(value, bool):
+            raise ValueError(f"{name} has an invalid '{key}': {value!r}")
+        if isinstance(value, (int, float)) and value < 0:
+            raise ValueError(f"{name} has a negative '{key}': {value!r}")
 
-def get_ul_fields(path):
+def validate_limits(entry, keys, name):
     """
-    Extracts and returns fields from the URL path, ensuring they are in the correct order:
-    GlobalConsensus, Parachain, AccountKey20, GeneralKey.
+    Check that the given upstream limits of a configuration entry, if set, are not zero.
+
+    :raises ValueError: If one of them is zero.
+    """
+    for key in keys:
+        if entry.get(key) == 0:
+            raise ValueError(f"{name} has a zero '{key}', leave it out to not limit the upstream")
+
+def build_consensus_index(supported_consensus):
+    """
+    Validate the chain entries and index them by location and by chain ID.
+
+    :param supported_consensus: The entries as loaded from supportedConsensus.json.
+    :return: A dict with the "entries", and the entries "by_location" keyed by the normalized
+             (GlobalConsensus, Parachain, PalletInstance) and "by_chain_id".
+    :raises ValueError: If an entry is invalid or two entries have the same location.
+    """
+    if not isinstance(supported_consensus, list):
+        raise ValueError("supportedConsensus.json must be a list")
+    by_location = {}
+    by_chain_id = {}
+    for index, entry in enumerate(supported_consensus):
+        validate_settings(entry, CONSENSUS_SCHEMA, f"Chain entry {index}")
+        validate_limits(entry, ('rpcRateLimit', 'rpcRateBurst', 'rpcMaxInFlight'), f"Chain entry {index}")
+        if not entry['rpc'] or not all(isinstance(rpc_url, str) for rpc_url in entry['rpc']):
+            raise ValueError(f"Chain entry {index} must have a non-empty list of 'rpc' URLs")
+        for kind, cache_control in entry.get('cacheControl', {}).items():
+            if kind not in DEFAULT_CACHE_CONTROL or not isinstance(cache_control, str):
+                raise ValueError(f"Chain entry {index} has an invalid 'cacheControl' for {kind!r}")
+        try:
+            location = tuple(
+                normalize_junction(junction, entry[junction]) for junction in UL_JUNCTIONS[:3])
+        except ValueError as e:
+            raise ValueError(f"Chain entry {index} has an invalid location: {e}")
+        if location in by_location:
+            raise ValueError(f"Chain entry {index} has the same location as another entry: {location}")
+        by_location[location] = entry
+        by_chain_id.setdefault(entry['ChainId'], entry)
+    return {"entries": supported_consensus, "by_location": by_location, "by_chain_id": by_chain_id}
+
+def build_ipfs_gateway_list(ipfs_gateways):
+    """
+    Validate the gateway entries.
+
+    :param ipfs_gateways: The entries as loaded from the gateway files.
+    :return: The list of gateway entries.
+    :raises ValueError: If an entry is invalid.
+    """
+    if not isinstance(ipfs_gateways, list):
+        raise ValueError("IPFS gateway files must be lists")
+    for index, gateway in enumerate(ipfs_gateways):
+        validate_settings(gateway, IPFS_GATEWAY_SCHEMA, f"IPFS gateway entry {index}")
+        validate_limits(gateway, ('rateLimit', 'rateBurst', 'maxInFlight'), f"IPFS gateway entry {index}")
+    return ipfs_gateways
+
+class ConfigRegistry:
+    """
+    Configuration parsed and indexed once, then shared by every request. The files are
+    checked for changes at most every CONFIG_CHECK_INTERVAL seconds, or on the next request
+    after SIGHUP, and a changed configuration replaces the previous one atomically. An
+    invalid file is only fatal on first load; later, the previous configuration is kept.
+    The objects built from a previous configuration are updated by on_change, called with
+    the new one under the registry lock, so it must not call get().
+    """
+
+    def __init__(self, paths, load, build, on_change=None):
+        self.paths = paths
+        self.load = load
+        self.build = build
+        self.on_change = on_change
+        self.config = None
+        self.mtimes = None
+        self.checked_at = 0.0
+        self.reload_requested = False
+        self._lock = threading.Lock()
+
+    def _mtimes(self):
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return mtimes
+
+    def _is_current(self):
+        return (self.config is not None and not self.reload_requested
+                and time.monotonic() - self.checked_at < CONFIG_CHECK_INTERVAL)
+
+    def get(self):
+        if self._is_current():
+            return self.config
+        with self._lock:
+            if self._is_current():
+                return self.config
+            self.checked_at = time.monotonic()
+            mtimes = self._mtimes()
+            if self.config is not None and not self.reload_requested and mtimes == self.mtimes:
+                return self.config
+            self.reload_requested = False
+            try:
+                config = self.build(self.load())
+            except (OSError, ValueError) as e:
+                if self.config is None:
+                    raise
+                # Not parsed again until the files change
+                self.mtimes = mtimes
+                logging.error(f"Invalid configuration in {', '.join(self.paths)}, keeping the previous one: {e}")
+                return self.config
+            previous = self.config
+            self.config = config
+            self.mtimes = mtimes
+            if previous is not None and self.on_change is not None:
+                self.on_change(config)
+            return config
+
+    def request_reload(self):
+        self.reload_requested = True
+
+# The loaders are looked up on every reload so they can be patched. The RPC clients and
+# gateway limiters, created on first use, are replaced when their settings change.
+consensus_registry = ConfigRegistry(
+    ['supportedConsensus.json'],
+    lambda: load_supported_consensus(),
+    build_consensus_index,
+    on_change=lambda config: refresh_rpc_clients(config),
+)
+ipfs_gateway_registry = ConfigRegistry(
+    ['supportedIPFSGateways.json', 'supportedIPFSGatewaysPrivate.json'],
+    lambda: load_supported_ipfs_gateways(),
+    build_ipfs_gateway_list,
+    on_change=lambda config: refresh_gateway_limiters(config),
+)
+
+def get_ipfs_gateways():
+    return ipfs_gateway_registry.get()
+
+def reload_configuration(signum=None, frame=None):
+    # Only flag the reload: the files are read by the next request, not in the signal handler
+    consensus_registry.request_reload()
+    ipfs_gateway_registry.request_reload()
+
+def load_configuration():
+    """
+    Load the configuration at startup, failing fast if it is invalid, and reload it on SIGHUP.
+    Must be called from the main thread.
+    """
+    consensus_registry.get()
+    ipfs_gateway_registry.get()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload_configuration)
+
+# The junctions of a universal location path, in the order they must appear
+UL_JUNCTIONS = ('GlobalConsensus', 'Parachain', 'PalletInstance', 'AccountKey20', 'GeneralKey')
+JUNCTION_PATTERN = re.compile(r'([A-Za-z0-9]+)\(([^()]*)\)')
+HEX_PATTERN = re.compile(r'0x[0-9a-fA-F]+')
+DECIMAL_PATTERN = re.compile(r'[0-9]+')
+ADDRESS_PATTERN = re.compile(r'0x[0-9a-fA-F]{40}')
+MAX_UINT256 = 2 ** 256 - 1
+
+class UniversalLocation(namedtuple('UniversalLocation', UL_JUNCTIONS)):
+    """
+    A parsed universal location. Values are normalized (lowercase hex, decimal numbers
+    without leading zeros) so that every spelling of a location has the same key.
     """
-    # Split the path into segments for easier parsing
-    path_segments = path.split('/')
+    __slots__ = ()
+
+    @property
+    def chain(self):
+        return self[:3]
+
+    @property
+    def key(self):
+        """
+        The canonical path of the location, used as its cache, coalescing and logging key.
+        """
+        return '/'.join(f"{junction}({value})" for junction, value in zip(UL_JUNCTIONS, self))
 
-    # Define the expected order of parameters
-    expected_order = ['GlobalConsensus', 'Parachain', 'PalletInstance', 'AccountKey20', 'GeneralKey']
+def normalize_decimal(value, maximum=None):
+    if not DECIMAL_PATTERN.fullmatch(value):
+        raise ValueError("must be a decimal integer")
+    number = int(value)
+    if maximum is not None and number > maximum:
+        raise ValueError(f"must not exceed {maximum}")
+    return str(number)
 
-    # Initialize a dictionary to store extracted values
-    values = {key: None for key in expected_order}
+def normalize_global_consensus(value):
+    if not value:
+        raise ValueError("must not be empty")
+    return HEX_PATTERN.sub(lambda match: match.group(0).lower(), value)
 
-    # Iterate through the expected fields and extract values
-    for expected in expected_order:
-        value = extract_between_parentheses(expected, path_segments)
-        if value is None:
-            # If a parameter is missing or out of order, abort the request
-            abort(400, description=f"URL parameter '{expected}' is missing or not in the expected order.")
+def normalize_account_key(value):
+    if not ADDRESS_PATTERN.fullmatch(value):
+        raise ValueError("must be a 20-byte hex address")
+    address = value[2:]
+    if address != address.lower() and address != address.upper() and not Web3.isChecksumAddress(value):
+        raise ValueError("has an invalid checksum")
+    return value.lower()
 
-        values[expected] = value
-        path_segments.pop(0)  # Remove the processed segment
+JUNCTION_NORMALIZERS = {
+    'GlobalConsensus': normalize_global_consensus,
+    'Parachain': normalize_decimal,
+    'PalletInstance': normalize_decimal,
+    'AccountKey20': normalize_account_key,
+    'GeneralKey': partial(normalize_decimal, maximum=MAX_UINT256),
+}
 
-    # Return the extracted values in the expected order
-    return tuple(values[key] for key in expected_order)
+def normalize_junction(junction, value):
+    """
+    Validate and normalize the value of a junction.
+
+    :raises ValueError: If the value is invalid for the junction.
+    """
+    return JUNCTION_NORMALIZERS[junction](value)
+
+def parse_universal_location(path):
+    """
+    Parse a universal location path in a single pass over its segments.
+
+    :param path: The path, e.g. 'GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0x...)/GeneralKey(1)'.
+    :return: The normalized UniversalLocation.
+    :raises BadRequest: If a junction is missing, out of order, or has an invalid value.
+    """
+    segments = [segment for segment in path.split('/') if segment]
+    values = []
+    for index, junction in enumerate(UL_JUNCTIONS):
+        match = JUNCTION_PATTERN.fullmatch(segments[index]) if index < len(segments) else None
+        if match is None or match.group(1) != junction:
+            raise BadRequest(description=f"URL parameter '{junction}' is missing or not in the expected order.")
+        try:
+            values.append(normalize_junction(junction, match.group(2)))
+        except ValueError as e:
+            raise BadRequest(description=f"URL parameter '{junction}' {e}.")
+    if len(segments) > len(UL_JUNCTIONS):
+        raise BadRequest(description=f"Unexpected URL segment '{segments[len(UL_JUNCTIONS)]}'.")
+    return UniversalLocation(*values)
+
+def get_ul_fields(path):
+    """
+    Extracts and returns fields from the URL path, ensuring they are in the correct order:
+    GlobalConsensus, Parachain, PalletInstance, AccountKey20, GeneralKey.
+    """
+    return parse_universal_location(path)
 
 def get_chain_info(global_consensus, parachain, pallet_instance):
     """
@@ -82,164 +520,2344 @@ def get_chain_info(global_consensus, parachain, pallet_instance):
     :param parachain: The parachain identifier.
     :return: A tuple containing the RPC URL and chain ID if found, or aborts with a 400 error if not found.
     """
-    supported_consensus = load_supported_consensus()  # Load the configuration
-    for entry in supported_consensus:
-        if (entry.get("GlobalConsensus") == global_consensus and
-                entry.get("Parachain") == parachain and
-                entry.get("PalletInstance") == pallet_instance):
-            return entry.get('rpc'), entry.get('ChainId')
+    entry = consensus_registry.get()["by_location"].get((global_consensus, parachain, pallet_instance))
+    if entry is None:
+        return None, None
+    return entry.get('rpc'), entry.get('ChainId')
+
+def get_location_chain(location):
+    """
+    Get the RPC URLs and chain ID of the chain of a universal location. Aborts with 404 if the
+    chain is not configured.
+
+    :param location: The UniversalLocation.
+    :return: A tuple containing the RPC URLs and the chain ID.
+    """
+    rpc_urls, chain_id = get_chain_info(*location.chain)
+    if not rpc_urls:
+        abort(404, description="RPC URLs not found.")
+    return rpc_urls, chain_id
 
-    return None, None
+def get_chain_settings(chain_id):
+    """
+    Get the configuration entry of the chain with the given chain ID.
 
+    :param chain_id: The chain ID as written in supportedConsensus.json.
+    :return: The chain entry if found, otherwise an empty dict.
+    """
+    return consensus_registry.get()["by_chain_id"].get(chain_id, {})
 
+def get_chain_name(chain_id):
+    if chain_id is None:
+        return 'unknown'
+    return get_chain_settings(chain_id).get('Name', str(chain_id))
 
-# Function to get the token_uri from a smart contract
-def get_token_uri(rpc_urls, contract_address, asset_id):
+def get_upstream_host(url):
+    """
+    Get the host of an upstream URL, without the path, query or credentials that may carry
+    an API key, to report it on /metrics and /admin/status.
+    """
+    return urlparse(url).netloc.rpartition('@')[2] or url
+
+def get_upstream_status(error):
+    """
+    Get the HTTP status of a failed upstream request for the metrics, or 'error' if the
+    upstream did not answer.
+    """
+    status = getattr(error, 'status', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return str(status) if status else 'error'
+
+def observe_rpc_call(chain_id, rpc_url, outcome, duration):
+    RPC_CALL_SECONDS.labels(get_chain_name(chain_id), get_upstream_host(rpc_url)).observe(duration)
+    UPSTREAM_RESPONSES.labels('rpc', outcome).inc()
+
+def count_token_uri_cache_lookup(chain_id, entry):
+    if entry is None:
+        result = 'miss'
+    elif entry["stale"]:
+        result = 'stale'
+    else:
+        result = 'negative' if entry["uri"] is None else 'hit'
+    TOKEN_URI_CACHE_LOOKUPS.labels(get_chain_name(chain_id), result).inc()
+
+class StageTimer:
+    """
+    Times the stages of a lookup, for the stage histogram and the Server-Timing header.
+    """
+
+    def __init__(self):
+        self.timings = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.monotonic() - start))
+
+    def observe(self, chain_id):
+        chain = get_chain_name(chain_id)
+        for name, duration in self.timings:
+            STAGE_SECONDS.labels(name, chain).observe(duration)
+
+    def server_timing(self):
+        return ', '.join(f"{name};dur={duration * 1000:.1f}" for name, duration in self.timings)
+
+class TokenNotFound(Exception):
+    """
+    Raised when the tokenURI call reverts, i.e. the token does not exist.
+    """
+
+def decode_token_uri_answer(answer):
+    """
+    Decode the JSON-RPC answer to a tokenURI eth_call.
+
+    :param answer: The JSON-RPC response object.
+    :return: The token URI, a TokenNotFound if the call reverted or a ValueError for any other error.
+    """
+    error = answer.get("error")
+    if error:
+        message = error.get("message", "")
+        if error.get("code") == 3 or 'revert' in message.lower():
+            return TokenNotFound(message)
+        return ValueError(message)
+    try:
+        return decode_abi(['string'], HexBytes(answer.get("result")))[0]
+    except Exception as e:
+        return ValueError(f"Invalid tokenURI output: {e}")
+
+class PooledHTTPProvider(Web3.HTTPProvider):
+    """
+    HTTPProvider that sends every request through the given requests.Session.
+
+    web3 caches sessions per thread, so a plain HTTPProvider opens a new connection
+    for each worker thread; this provider shares one bounded pool across all of them.
+    """
+
+    def __init__(self, endpoint_uri, session, request_kwargs=None):
+        super().__init__(endpoint_uri, request_kwargs=request_kwargs)
+        self.session = session
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        response = self.session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+class EndpointHealth:
+    """
+    Rolling latency and error rate of an upstream endpoint, with a closed/open/half-open
+    circuit breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, url):
+        self.url = url
+        self.state = self.CLOSED
+        self.latency = None
+        self.samples = deque(maxlen=HEALTH_WINDOW)
+        self.outcomes = deque(maxlen=HEALTH_WINDOW)
+        self.consecutive_failures = 0
+        self.opened_count = 0
+        self.retry_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def latency_percentile(self, percentile):
+        """
+        Latency percentile over the last successful calls, or None without enough samples.
+        """
+        with self._lock:
+            samples = sorted(self.samples)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(int(len(samples) * percentile), len(samples) - 1)]
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def is_available(self):
+        """
+        Whether a request could be sent now, without claiming the half-open probe.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.monotonic() >= self.retry_at
+            return not self.probing
+
+    def allow_request(self):
+        """
+        Whether a request may be sent now. Once the backoff of an open breaker expires, a
+        single probe request is let through in the half-open state.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self.retry_at:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self, latency):
+        with self._lock:
+            self.outcomes.append(True)
+            self.samples.append(latency)
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+            self.consecutive_failures = 0
+            self.opened_count = 0
+            self.probing = False
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            self.probing = False
+            if (self.state == self.HALF_OPEN
+                    or self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD
+                    or (len(self.outcomes) >= BREAKER_FAILURE_THRESHOLD
+                        and self.error_rate() >= BREAKER_ERROR_RATE)):
+                self._open()
+
+    def _open(self):
+        self.opened_count += 1
+        backoff = min(BREAKER_BASE_BACKOFF * 2 ** (self.opened_count - 1), BREAKER_MAX_BACKOFF)
+        # Full jitter keeps workers from probing a recovering node all at once
+        self.retry_at = time.monotonic() + random.uniform(backoff / 2, backoff)
+        self.state = self.OPEN
+
+    def sort_key(self):
+        # Endpoints without measurements yet go first so they get a latency sample
+        return self.latency if self.latency is not None else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "latency": self.latency,
+                "errorRate": self.error_rate(),
+                "consecutiveFailures": self.consecutive_failures,
+                "retryIn": max(self.retry_at - time.monotonic(), 0.0) if self.state == self.OPEN else 0.0,
+            }
+
+class TokenBucket:
+    """
+    Rate limiter letting through "rate" operations per second on average, in bursts of up to
+    "burst". Taking more tokens than available puts the bucket in debt, so that large
+    batches are paced instead of refused.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(self.rate, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, count=1):
+        """
+        Take count tokens, waiting until the bucket is out of debt.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def try_acquire(self, count=1):
+        """
+        Take count tokens if the bucket has them, without waiting or going into debt.
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens < count:
+                return False
+            self.tokens -= count
+            return True
+
+    def retry_after(self, count=1):
+        """
+        Seconds until count tokens are available.
+        """
+        with self._lock:
+            self._refill()
+            return max(count - self.tokens, 0) / self.rate
+
+class UpstreamLimiter:
+    """
+    Limits of the requests to an upstream: a token bucket of "rate" requests per second and
+    a cap of "max_in_flight" concurrent requests, each unlimited if None. Requests over a
+    limit are not queued, the caller moves on to another upstream instead.
+    """
+
+    def __init__(self, url, kind, rate=None, burst=None, max_in_flight=None):
+        self.url = url
+        self.kind = kind
+        self.settings = (rate, burst, max_in_flight)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Claim a request to the upstream if it is within its limits. A claimed request must
+        be released once done.
+        """
+        with self._lock:
+            if ((self.max_in_flight is not None and self.in_flight >= self.max_in_flight)
+                    or (self.bucket is not None and not self.bucket.try_acquire())):
+                self.throttled += 1
+                UPSTREAM_THROTTLED.labels(self.kind, get_upstream_host(self.url)).inc()
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def retry_after(self):
+        return self.bucket.retry_after() if self.bucket is not None else 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rateLimit": self.bucket.rate if self.bucket is not None else None,
+                "maxInFlight": self.max_in_flight,
+                "inFlight": self.in_flight,
+                "throttled": self.throttled,
+            }
+
+class UpstreamThrottled(Exception):
+    """
+    Raised instead of sending a request to an upstream over its limits.
+    """
+
+    def __init__(self, limiter):
+        super().__init__(f"{get_upstream_host(limiter.url)} is over its rate limit or in-flight cap")
+        self.limiter = limiter
+
+def throttled_error(limiters):
+    """
+    Build the 503 answered when every upstream that could serve a request is over its limits,
+    asking to retry once the first of them accepts requests again.
+    """
+    retry_after = min(limiter.retry_after() for limiter in limiters)
+    return ServiceUnavailable(
+        description="Upstreams are over their rate limits, retry later.",
+        retry_after=max(math.ceil(retry_after), LOOKUP_RETRY_AFTER))
+
+def lookup_refused(queue, reason):
+    LOOKUPS_SHED.labels(queue, reason).inc()
+    return ServiceUnavailable(description="The gateway is overloaded, retry later.", retry_after=LOOKUP_RETRY_AFTER)
+
+class AdmissionQueue:
+    """
+    Bounded queue of the lookups that have to go upstream: at most max_concurrency hold a
+    slot at once and up to max_queued wait for one, each for at most timeout seconds. A
+    lookup that cannot queue or whose deadline passes is refused with a 503.
+    The Flask and the asyncio entry points each have their own queue, named after them.
+    Waiting lookups hold their thread, hence the small default max_queued.
+    """
+
+    def __init__(self, max_concurrency=LOOKUP_MAX_CONCURRENCY, max_queued=LOOKUP_THREAD_QUEUE_SIZE,
+                 timeout=LOOKUP_QUEUE_TIMEOUT, name='flask'):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.running = 0
+        self.queued = 0
+        self.counters = {"admitted": 0, "queueFull": 0, "timedOut": 0}
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        self._acquire()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.running -= 1
+                self._condition.notify()
+
+    def _acquire(self):
+        with self._condition:
+            if self.running >= self.max_concurrency:
+                if self.queued >= self.max_queued:
+                    self.counters["queueFull"] += 1
+                    raise lookup_refused(self.name, 'queue_full')
+                self.queued += 1
+                try:
+                    if not self._condition.wait_for(
+                            lambda: self.running < self.max_concurrency, timeout=self.timeout):
+                        self.counters["timedOut"] += 1
+                        raise lookup_refused(self.name, 'timeout')
+                finally:
+                    self.queued -= 1
+            self.running += 1
+            self.counters["admitted"] += 1
+
+    def stats(self):
+        with self._condition:
+            return {"running": self.running, "queued": self.queued, **self.counters}
+
+_admission_queues = {}
+
+def register_admission_queue(queue):
+    """
+    Report the state of the admission queue of the Flask or the asyncio entry point on
+    /admin/status and /metrics under its name.
+    """
+    _admission_queues[queue.name] = queue
+    for state in ('running', 'queued'):
+        ADMISSION_QUEUE_LOOKUPS.labels(queue.name, state).set_function(lambda state=state: queue.stats()[state])
+
+def get_admission_stats():
+    return {name: queue.stats() for name, queue in list(_admission_queues.items())}
+
+lookup_queue = AdmissionQueue()
+register_admission_queue(lookup_queue)
+
+class RPCClient:
+    """
+    Keep-alive client for a single RPC URL, with a cache of tokenURI contract objects
+    per contract address and the limits of the requests to the URL.
+    """
+
+    def __init__(self, rpc_url, pool_size=DEFAULT_RPC_POOL_SIZE, timeout=DEFAULT_RPC_TIMEOUT,
+                 rate_limit=None, rate_burst=None, max_in_flight=None):
+        self.rpc_url = rpc_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.settings = {"pool_size": pool_size, "timeout": timeout, "rate_limit": rate_limit,
+                         "rate_burst": rate_burst, "max_in_flight": max_in_flight}
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.web3 = Web3(PooledHTTPProvider(rpc_url, self.session, request_kwargs={'timeout': timeout}))
+        # The validation middleware asks the node for eth_chainId before every eth_call,
+        # doubling the round trips of a read-only lookup.
+        self.web3.middleware_onion.remove('validation')
+        self.health = EndpointHealth(rpc_url)
+        self.limiter = UpstreamLimiter(rpc_url, 'rpc', rate_limit, rate_burst, max_in_flight)
+        self.contracts = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_contract(self, contract_address):
+        key = contract_address.lower()
+        contract = self.contracts.get(key)
+        if contract is None:
+            checksum_address = self.web3.toChecksumAddress(contract_address)
+            contract = self.web3.eth.contract(address=checksum_address, abi=TOKEN_URI_ABI)
+            with self._lock:
+                contract = self.contracts.setdefault(key, contract)
+        return contract
+
+    def call_token_uri(self, contract, asset_id):
+        with self._lock:
+            self.calls += 1
+        return contract.functions.tokenURI(int(asset_id)).call()
+
+    def batch_call_token_uri(self, lookups):
+        """
+        Call tokenURI for many tokens in a single JSON-RPC batch request.
+
+        :param lookups: A list of (contract_address, asset_id) pairs.
+        :return: A list with, for each lookup, the token URI, a TokenNotFound if the call
+                 reverted or a ValueError for any other error. Raises if the request fails.
+        """
+        payload = [
+            self.token_uri_request(contract_address, asset_id, request_id)
+            for request_id, (contract_address, asset_id) in enumerate(lookups)
+        ]
+        with self._lock:
+            self.calls += len(payload)
+        response = self.session.post(self.rpc_url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        answers = response.json()
+        if not isinstance(answers, list):
+            raise ValueError(f"Batch requests not supported: {answers}")
+
+        results = [ValueError("Missing response")] * len(payload)
+        for answer in answers:
+            request_id = answer.get("id")
+            if isinstance(request_id, int) and 0 <= request_id < len(payload):
+                results[request_id] = decode_token_uri_answer(answer)
+        return results
+
+    def token_uri_request(self, contract_address, asset_id, request_id=1):
+        """
+        Build the JSON-RPC eth_call request of tokenURI(asset_id) on the given contract.
+        """
+        contract = self.get_contract(contract_address)
+        data = contract.encodeABI(fn_name='tokenURI', args=[int(asset_id)])
+        return {
+            "jsonrpc": "2.0",
+            "id": request_id,
+            "method": "eth_call",
+            "params": [{"to": contract.address, "data": data}, "latest"],
+        }
+
+    def stats(self):
+        """
+        Connection counters as seen by urllib3: every request served over an already
+        open connection counts as a reuse.
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        requests_sent = 0
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            "poolSize": self.pool_size,
+            "timeout": self.timeout,
+            "calls": self.calls,
+            "connectionsOpened": connections,
+            "requestsSent": requests_sent,
+            "connectionsReused": max(requests_sent - connections, 0),
+            "cachedContracts": len(self.contracts),
+            "health": self.health.stats(),
+            "limits": self.limiter.stats(),
+        }
+
+_rpc_clients = {}
+_rpc_clients_lock = threading.Lock()
+
+def get_rpc_client(rpc_url, chain_id=None):
+    """
+    Get the process-wide RPC client for the given chain and RPC URL, creating it on first use
+    with the pool size, timeout and limits configured for the chain.
+
+    :param rpc_url: The RPC URL of the node.
+    :param chain_id: The chain ID the RPC URL belongs to, used to look up the client settings.
+    :return: The RPCClient for the pair.
+    """
+    key = (chain_id, rpc_url)
+    client = _rpc_clients.get(key)
+    if client is not None:
+        return client
+    settings = get_chain_settings(chain_id) if chain_id is not None else {}
+    with _rpc_clients_lock:
+        client = _rpc_clients.get(key)
+        if client is None:
+            client = _rpc_clients[key] = RPCClient(rpc_url, **get_rpc_client_settings(settings))
+    return client
+
+def get_rpc_client_settings(settings):
+    """
+    Get the RPCClient arguments configured in a chain entry.
+    """
+    return {
+        "pool_size": int(settings.get('rpcPoolSize', DEFAULT_RPC_POOL_SIZE)),
+        "timeout": float(settings.get('rpcTimeout', DEFAULT_RPC_TIMEOUT)),
+        "rate_limit": settings.get('rpcRateLimit'),
+        "rate_burst": settings.get('rpcRateBurst'),
+        "max_in_flight": settings.get('rpcMaxInFlight'),
+    }
+
+def refresh_rpc_clients(config):
+    """
+    Replace the RPC clients whose settings changed in a reloaded consensus configuration.
+    The replacement keeps the health of the endpoint; requests in flight finish on the
+    previous client.
+
+    :param config: The new consensus index.
+    """
+    with _rpc_clients_lock:
+        for (chain_id, rpc_url), client in list(_rpc_clients.items()):
+            settings = get_rpc_client_settings(config["by_chain_id"].get(chain_id, {}) if chain_id is not None else {})
+            if settings != client.settings:
+                replacement = RPCClient(rpc_url, **settings)
+                replacement.health = client.health
+                _rpc_clients[(chain_id, rpc_url)] = replacement
+
+def get_rpc_client_stats():
+    """
+    Return the connection counters of every RPC client created so far, by host.
+    """
+    with _rpc_clients_lock:
+        clients = list(_rpc_clients.items())
+    return [
+        {"chainId": chain_id, "host": get_upstream_host(rpc_url), **client.stats()}
+        for (chain_id, rpc_url), client in clients
+    ]
+
+def order_rpc_clients(rpc_urls, chain_id=None):
+    """
+    Get the clients of the given RPC URLs that accept requests right now, fastest first.
+    Endpoints with an open breaker are left out; ties keep the configured order.
+
+    :param rpc_urls: A list of RPC URLs of the EVM-compatible blockchain nodes.
+    :param chain_id: The chain ID of the RPC URLs.
+    :return: A list of RPCClient.
+    """
+    clients = [get_rpc_client(rpc_url, chain_id) for rpc_url in rpc_urls]
+    available = [client for client in clients if client.health.is_available()]
+    return sorted(available, key=lambda client: client.health.sort_key())
+
+def resolve_token_uri(rpc_urls, contract_address, asset_id, chain_id=None):
     """
-    Call an EVM chain RPC nodes provided in round-robin fashion to get the token_uri for a given 
-    contract address and assetId. Retries up to the number of RPC URLs provided with a 1-second 
-    delay between retries if an error occurs.
+    Call the EVM chain RPC nodes provided, fastest healthy node first, to get the token_uri
+    for a given contract address and assetId. Falls through to the next node without delay
+    if an error occurs; nodes whose circuit breaker is open or that are over their limits are
+    skipped. A reverted call means the token does not exist and is not retried.
 
     :param rpc_urls: A list of RPC URLs of the EVM-compatible blockchain nodes.
     :param contract_address: The address of the smart contract.
     :param asset_id: The asset ID for which to retrieve the token URI.
-    :return: The token URI if found, otherwise None.
+    :param chain_id: The chain ID of the RPC URLs, used to pick the client settings.
+    :return: The token URI, or None if no RPC node answered. Raises TokenNotFound if the call
+             reverted, or a ServiceUnavailable if the nodes that did not fail are over their limits.
     """
-    contract_abi = [
-        {
-            "constant": True,
-            "inputs": [{"name": "_tokenId", "type": "uint256"}],
-            "name": "tokenURI",
-            "outputs": [{"name": "", "type": "string"}],
-            "payable": False,
-            "stateMutability": "view",
-            "type": "function",
-        },
-    ]
-    
-    # Initialize the counter and number of RPC URLs
-    attempts = 0
-    num_rpc_urls = len(rpc_urls)
-
-    while attempts < num_rpc_urls:
-        rpc_url = rpc_urls[attempts % num_rpc_urls]  # Round-robin selection
-        web3 = Web3(Web3.HTTPProvider(rpc_url))
-        checksum_address = web3.toChecksumAddress(contract_address)
-        contract = web3.eth.contract(address=checksum_address, abi=contract_abi)
-        
-        try:
-            token_uri = contract.functions.tokenURI(int(asset_id)).call()
-            return token_uri
+    clients = order_rpc_clients(rpc_urls, chain_id)
+    if not clients:
+        logging.error("All RPC URLs are unavailable, circuit breakers are open.")
+        return None
+
+    failed = False
+    throttled = []
+    for attempt, client in enumerate(clients):
+        contract = client.get_contract(contract_address)
+        if not claim_rpc_client(client, chain_id, throttled, failed):
+            continue
+        start = time.monotonic()
+        try:
+            token_uri = client.call_token_uri(contract, asset_id)
+        except ContractLogicError as e:
+            token_uri = TokenNotFound(str(e))
         except Exception as e:
-            logging.error(f"Attempt {attempts+1}: Error occurred with RPC URL {rpc_url}: {e}")
-            time.sleep(1)  # Delay for 1 second before the next attempt
-            attempts += 1
-    
+            token_uri = e
+        finally:
+            client.limiter.release()
+        if record_token_uri_call(client, chain_id, token_uri, time.monotonic() - start, attempt):
+            return token_uri
+        failed = True
+    return token_uri_unresolved(throttled)
+
+def claim_rpc_client(client, chain_id, throttled, retry=False):
+    """
+    Take a request slot of an RPC node, skipping it if it is over its limits or its circuit
+    breaker is open. The caller releases the slot with client.limiter.release().
+
+    :param client: The RPCClient.
+    :param chain_id: The chain ID of the node.
+    :param throttled: The list of the limiters of the nodes skipped for their limits, appended to.
+    :param retry: Whether another node already failed, counted as a retry.
+    :return: Whether the request can be sent.
+    """
+    if not client.limiter.try_acquire():
+        throttled.append(client.limiter)
+        return False
+    if not client.health.allow_request():
+        client.limiter.release()
+        return False
+    if retry:
+        RPC_RETRIES.labels(get_chain_name(chain_id)).inc()
+    return True
+
+def record_token_uri_call(client, chain_id, outcome, latency, attempt=0):
+    """
+    Record a tokenURI call in the health of the node and the metrics. A reverted call means
+    the node answered and the token does not exist: it is raised, as it is not retried.
+
+    :param client: The RPCClient called.
+    :param chain_id: The chain ID of the node.
+    :param outcome: The token URI, a TokenNotFound if the call reverted, or the exception the
+                    call failed with.
+    :param latency: The duration of the call in seconds.
+    :param attempt: The index of the node in the failover order, for the logs.
+    :return: Whether the call succeeded; raises the TokenNotFound if it reverted.
+    """
+    if isinstance(outcome, TokenNotFound):
+        client.health.record_success(latency)
+        observe_rpc_call(chain_id, client.rpc_url, 'reverted', latency)
+        logging.error(f"Call reverted with RPC URL {client.rpc_url}: {outcome}")
+        raise outcome
+    if isinstance(outcome, Exception):
+        client.health.record_failure()
+        observe_rpc_call(chain_id, client.rpc_url, 'error', latency)
+        logging.error(f"Attempt {attempt+1}: Error occurred with RPC URL {client.rpc_url}: {outcome}")
+        return False
+    client.health.record_success(latency)
+    observe_rpc_call(chain_id, client.rpc_url, 'ok', latency)
+    return True
+
+def token_uri_unresolved(throttled):
+    """
+    The outcome of a tokenURI lookup no node answered: a ServiceUnavailable is raised if
+    some nodes were skipped for their limits, otherwise None is returned.
+    """
+    if throttled:
+        logging.error("Failed to fetch token URI, RPC URLs are over their limits.")
+        raise throttled_error(throttled)
     logging.error("Failed to fetch token URI after trying all RPC URLs.")
     return None
 
-def is_valid_url(url):
-    try:
-        result = urlparse(url)
-        logging.info(f"Processing URL: {result.geturl()}")
-        return all([result.scheme, result.netloc])
-    except ValueError:
-        return False
+_single_flights = []
 
-def fetch_url_content(url):
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()  # Raises an exception for HTTP errors
-        return response.text
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching the URL content: {e}")
-        return None
+def register_single_flight(flight):
+    """
+    Report the counters of a single flight, of the Flask or the asyncio entry point, on
+    /admin/status and /metrics under its name.
+    """
+    _single_flights.append(flight)
 
-def is_valid_ipfs(token_uri):
-    return token_uri.startswith('ipfs://')
+def count_single_flight_call(flight, leader):
+    if flight.name is not None:
+        SINGLE_FLIGHT_CALLS.labels(flight.name, 'executed' if leader else 'coalesced').inc()
 
-def fetch_ipfs_content(token_uri):
-    # token_uri if forced to start with ipfs:// outside this method
-    # Extract the CID and construct the URL with the IPFS gateway
-    cid = token_uri.split('ipfs://')[1]
+def single_flight_stats(calls, executions, in_flight):
+    return {
+        "calls": calls,
+        "executions": executions,
+        "coalesced": calls - executions,
+        "coalescingRatio": calls / executions if executions else 1.0,
+        "inFlight": in_flight,
+    }
 
-    ipfs_gateways = load_supported_ipfs_gateways()  # Load the configuration data
-    for gateway in ipfs_gateways:
-        ipfs_gateway_url = gateway.get("url")
-        # example of suffix = "?pinataGatewayToken=2z....Nk" 
-        apiKeySuffix = gateway.get("apiKeySuffix")
-        full_uri = f'{ipfs_gateway_url}{cid}{apiKeySuffix}'
-        try:
-            response = requests.get(full_uri)
-            response.raise_for_status()  # Raises HTTPError for unsuccessful status codes
-            return response.json()
-        except requests.exceptions.HTTPError as http_err:
-            logging.error(f"HTTP error occurred with {ipfs_gateway_url}: {http_err}")
-            # Continue to the next gateway if this one fails
-        except Exception as err:
-            logging.error(f"An error occurred with {ipfs_gateway_url}: {err}")
-            # Continue to the next gateway if this one fails
+def get_coalescing_stats():
+    """
+    Sum the counters of the registered single flights by name.
+    """
+    totals = {}
+    for flight in list(_single_flights):
+        stats = flight.stats()
+        total = totals.setdefault(flight.name, {"calls": 0, "executions": 0, "inFlight": 0})
+        for counter in total:
+            total[counter] += stats[counter]
+    return {
+        name: single_flight_stats(total["calls"], total["executions"], total["inFlight"])
+        for name, total in totals.items()
+    }
 
-    logging.error("Failed to fetch data from all IPFS gateways.")
-    return None
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the operation and
+    the others wait for it and share its result or exception. Named flights are registered
+    for reporting.
+    """
 
+    def __init__(self, name=None):
+        self.name = name
+        self.in_flight = {}
+        self.counters = {"calls": 0, "executions": 0}
+        self._lock = threading.Lock()
+        if name is not None:
+            register_single_flight(self)
 
-@app.errorhandler(Exception)
-def handle_exception(e):
-    """Return JSON instead of HTML for HTTP errors."""
-    response = e.get_response()
-    response.data = json.dumps({
-        "code": e.code,
-        "name": e.name,
-        "description": e.description,
-    })
-    response.content_type = "application/json"
-    return response
+    def do(self, key, fn):
+        with self._lock:
+            self.counters["calls"] += 1
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = {"done": threading.Event(), "result": None, "error": None}
+                self.counters["executions"] += 1
+        count_single_flight_call(self, leader)
 
-@app.route('/robots.txt')
-@app.route('/favicon.ico')
-def static_from_root():
-    return send_from_directory(app.static_folder, request.path[1:])
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
 
-@app.route('/<path:path>', methods=['GET'])
-def handle_request(path):
-    try:
-        global_consensus, parachain, pallet_instance, account_key, general_key = get_ul_fields(path)
-        if not all([global_consensus, parachain, pallet_instance, account_key, general_key]):
-            abort(400, description="Invalid URL format.")
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self.in_flight[key]
+            call["done"].set()
 
-        rpc_urls, chain_id = get_chain_info(global_consensus, parachain, pallet_instance)
+    def stats(self):
+        with self._lock:
+            return single_flight_stats(self.counters["calls"], self.counters["executions"], len(self.in_flight))
 
-        if not rpc_urls:
-            abort(404, description="RPC URLs not found.")
+# In-flight deduplication of tokenURI resolutions, keyed like the tokenURI cache, and of
+# content fetches, keyed by URI
+token_uri_flight = SingleFlight('tokenUri')
+content_flight = SingleFlight('content')
 
-        token_uri = get_token_uri(rpc_urls, account_key, general_key)
-        if not token_uri:
-            abort(404, description="Token URI not found")
+class MemoryCacheBackend:
+    """
+    In-process cache backend: an LRU dict whose entries are dropped once their lifetime is over.
+    """
+
+    def __init__(self, max_entries=TOKEN_URI_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
 
-        if is_valid_ipfs(token_uri):
-            token_uri_result = fetch_ipfs_content(token_uri)
-            if not token_uri_result:
-                abort(502, description=f"Failed to fetch data from IPFS {token_uri}")
-            return jsonify(token_uri_result)
+    def get(self, key):
+        with self._lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if time.time() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
 
-        if is_valid_url(token_uri):
-            token_uri_result = fetch_url_content(token_uri)
-            if not token_uri_result:
-                abort(502, description=f"Failed to fetch data from URL {token_uri}")      
-            logging.info(token_uri)
-            logging.info(token_uri_result)
-            return token_uri_result
+    def set(self, key, value, lifetime):
+        with self._lock:
+            self.entries[key] = (value, time.time() + lifetime)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
 
-        # If the URI is not IPFS nor a valid URL, just return the content of token_uri
-        return jsonify({"token_uri": token_uri})
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+class RedisCacheBackend:
+    """
+    Cache backend on a Redis-compatible server, shared by every worker using the same URL.
+    Requires the redis package.
+    """
+
+    def __init__(self, url, prefix='ulgateway:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, lifetime):
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(int(lifetime), 1))
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+class TokenURICache:
+    """
+    Cache of resolved tokenURIs with stale-while-revalidate: an entry is fresh for the TTL of
+    its chain, then served stale for up to its stale TTL while it is refreshed in the
+    background. Reverted calls are cached as missing tokens for the negative TTL.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.counters = {"hits": 0, "staleHits": 0, "negativeHits": 0, "misses": 0, "refreshes": 0}
+        self.refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=TOKEN_URI_REFRESH_WORKERS, thread_name_prefix='token-uri-refresh')
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def get(self, key):
+        """
+        Get the cached entry of a key, a dict with the token URI ("uri", None for a missing
+        token) and whether it is "stale".
+        """
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            logging.error(f"Error reading {key} from the tokenURI cache: {e}")
+            entry = None
+        if entry is None:
+            self._count("misses")
+            return None
+        stale = time.time() >= entry["expires"]
+        self._count("staleHits" if stale else "negativeHits" if entry["uri"] is None else "hits")
+        return {"uri": entry["uri"], "stale": stale}
+
+    def put(self, key, token_uri, ttl, stale_ttl):
+        try:
+            self.backend.set(key, {"uri": token_uri, "expires": time.time() + ttl}, ttl + stale_ttl)
+        except Exception as e:
+            logging.error(f"Error writing {key} to the tokenURI cache: {e}")
+
+    def refresh_in_background(self, key, refresh):
+        """
+        Run refresh() in the background unless a refresh of the key is already running.
+        """
+        with self._lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+            self.counters["refreshes"] += 1
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                logging.error(f"Error refreshing {key} in the tokenURI cache: {e}")
+            finally:
+                with self._lock:
+                    self.refreshing.discard(key)
+        self._executor.submit(run)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+def make_token_uri_cache_backend():
+    if TOKEN_URI_CACHE_REDIS_URL:
+        return RedisCacheBackend(TOKEN_URI_CACHE_REDIS_URL)
+    return MemoryCacheBackend()
+
+token_uri_cache = TokenURICache(make_token_uri_cache_backend())
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONTENT_WORKERS, thread_name_prefix='batch')
+
+def token_uri_cache_key(rpc_urls, contract_address, asset_id, chain_id=None):
+    """
+    The key of a token in the tokenURI cache and single-flight when it is looked up without
+    a universal location. Lookups of a location use its canonical UniversalLocation.key.
+    """
+    chain_key = chain_id if chain_id is not None else ','.join(rpc_urls)
+    return f"{chain_key}/{contract_address.lower()}/{asset_id}"
+
+def store_token_uri(key, token_uri, chain_id=None):
+    """
+    Store a resolved token URI, or None for a token that does not exist, in the tokenURI
+    cache with the TTLs configured for the chain.
+    """
+    settings = get_chain_settings(chain_id) if chain_id is not None else {}
+    if token_uri is None:
+        token_uri_cache.put(key, None, float(settings.get('tokenUriNegativeTtl', DEFAULT_TOKEN_URI_NEGATIVE_TTL)), 0)
+        return
+    token_uri_cache.put(
+        key,
+        token_uri,
+        float(settings.get('tokenUriTtl', DEFAULT_TOKEN_URI_TTL)),
+        float(settings.get('tokenUriStaleTtl', DEFAULT_TOKEN_URI_STALE_TTL)),
+    )
+
+def fetch_and_cache_token_uri(key, rpc_urls, contract_address, asset_id, chain_id=None):
+    """
+    Resolve the token URI and store the outcome in the tokenURI cache. Failures to reach
+    the chain are not cached.
+    """
+    try:
+        token_uri = resolve_token_uri(rpc_urls, contract_address, asset_id, chain_id)
+    except TokenNotFound as e:
+        token_uri = e
+    return store_resolved_token_uri(key, token_uri, chain_id)
+
+def store_resolved_token_uri(key, token_uri, chain_id=None):
+    """
+    Store the outcome of a tokenURI lookup in the tokenURI cache: a TokenNotFound is cached
+    as a token that does not exist, and None, when no node answered, is not cached.
+
+    :return: The token URI, or None.
+    """
+    if isinstance(token_uri, TokenNotFound):
+        store_token_uri(key, None, chain_id)
+        return None
+    if token_uri is not None:
+        store_token_uri(key, token_uri, chain_id)
+    return token_uri
+
+def get_cached_token_uri(key, rpc_urls, contract_address, asset_id, chain_id=None):
+    """
+    Read a token in the tokenURI cache, counting the lookup. A stale entry is refreshed in
+    the background.
+
+    :return: The cache entry, or None on a miss.
+    """
+    entry = token_uri_cache.get(key)
+    count_token_uri_cache_lookup(chain_id, entry)
+    if entry is not None and entry["stale"]:
+        token_uri_cache.refresh_in_background(
+            key, partial(fetch_and_cache_token_uri, key, rpc_urls, contract_address, asset_id, chain_id))
+    return entry
+
+# Function to get the token_uri from a smart contract
+def get_token_uri(rpc_urls, contract_address, asset_id, chain_id=None, key=None):
+    """
+    Get the token_uri for a given contract address and assetId, from the tokenURI cache if
+    possible. Stale entries are returned right away and refreshed in the background.
+
+    :param rpc_urls: A list of RPC URLs of the EVM-compatible blockchain nodes.
+    :param contract_address: The address of the smart contract.
+    :param asset_id: The asset ID for which to retrieve the token URI.
+    :param chain_id: The chain ID of the RPC URLs, used to pick the client and cache settings.
+    :param key: The cache and single-flight key, the UniversalLocation.key of the token if known.
+    :return: The token URI if found, otherwise None.
+    """
+    if key is None:
+        key = token_uri_cache_key(rpc_urls, contract_address, asset_id, chain_id)
+    entry = get_cached_token_uri(key, rpc_urls, contract_address, asset_id, chain_id)
+    if entry is not None:
+        return entry["uri"]
+
+    def fetch_and_cache():
+        with lookup_queue.slot():
+            return fetch_and_cache_token_uri(key, rpc_urls, contract_address, asset_id, chain_id)
+    return token_uri_flight.do(key, fetch_and_cache)
+
+def resolve_token_uris_batch(rpc_urls, lookups, chain_id=None):
+    """
+    Resolve many token URIs of one chain with JSON-RPC batch requests of at most the chain's
+    "rpcBatchSize" calls. A chunk whose batch request fails is retried on the next healthy node
+    within its limits.
+
+    :param rpc_urls: A list of RPC URLs of the EVM-compatible blockchain nodes.
+    :param lookups: A list of (contract_address, asset_id) pairs.
+    :param chain_id: The chain ID of the RPC URLs.
+    :return: A list with, for each lookup, the token URI, a TokenNotFound or another exception,
+             a ServiceUnavailable if the nodes that did not fail are over their limits.
+    """
+    results = [None] * len(lookups)
+    valid = []
+    for index, (contract_address, asset_id) in enumerate(lookups):
+        # A malformed lookup is the client's error: it is never sent, so it cannot count
+        # against the health of the node that would have received it
+        try:
+            normalize_account_key(contract_address)
+            normalize_decimal(str(asset_id), MAX_UINT256)
+        except ValueError as e:
+            results[index] = ValueError(f"Invalid lookup {contract_address}/{asset_id}: {e}")
+            continue
+        valid.append(index)
+
+    settings = get_chain_settings(chain_id) if chain_id is not None else {}
+    chunk_size = int(settings.get('rpcBatchSize', DEFAULT_RPC_BATCH_SIZE))
+    for offset in range(0, len(valid), chunk_size):
+        indexes = valid[offset:offset + chunk_size]
+        chunk = [lookups[index] for index in indexes]
+        chunk_results = None
+        failed = False
+        throttled = []
+        for client in order_rpc_clients(rpc_urls, chain_id):
+            if not claim_rpc_client(client, chain_id, throttled, failed):
+                continue
+            start = time.monotonic()
+            try:
+                chunk_results = client.batch_call_token_uri(chunk)
+                latency = time.monotonic() - start
+                client.health.record_success(latency)
+                observe_rpc_call(chain_id, client.rpc_url, 'ok', latency)
+                break
+            except Exception as e:
+                client.health.record_failure()
+                observe_rpc_call(chain_id, client.rpc_url, 'error', time.monotonic() - start)
+                failed = True
+                logging.error(f"Batch of {len(chunk)} calls failed with RPC URL {client.rpc_url}: {e}")
+            finally:
+                client.limiter.release()
+        if chunk_results is None:
+            if throttled:
+                error = throttled_error(throttled)
+            else:
+                error = ConnectionError("Failed to fetch token URIs after trying all RPC URLs.")
+            chunk_results = [error] * len(chunk)
+        for index, result in zip(indexes, chunk_results):
+            results[index] = result
+    return results
+
+def is_valid_url(url):
+    try:
+        result = urlparse(url)
+        logging.info(f"Processing URL: {result.geturl()}")
+        return all([result.scheme, result.netloc])
+    except ValueError:
+        return False
+
+def open_upstream_stream(url, timeout, passthrough=False):
+    """
+    Send a GET request without reading the body, checking the status and the announced size.
+
+    :param url: The URL to fetch.
+    :param timeout: The timeout in seconds.
+    :param passthrough: Ask for an uncompressed body, so it can be forwarded as is with its
+                        Content-Length.
+    :return: The streamed requests.Response; raises if the request fails or is too large.
+    """
+    headers = {'Accept-Encoding': 'identity'} if passthrough else None
+    response = requests.get(url, timeout=timeout, stream=True, headers=headers)
+    try:
+        response.raise_for_status()  # Raises an exception for HTTP errors
+        content_length = response.headers.get('Content-Length')
+        if content_length and int(content_length) > MAX_PROXY_BODY_SIZE:
+            raise ValueError(f"Content-Length {content_length} exceeds the maximum of {MAX_PROXY_BODY_SIZE} bytes")
+    except Exception:
+        response.close()
+        raise
+    return response
+
+def fetch_url_content(url):
+    start = time.monotonic()
+    try:
+        response = open_upstream_stream(url, URL_FETCH_TIMEOUT)
+        UPSTREAM_RESPONSES.labels('http', str(response.status_code)).inc()
+        with response:
+            body = read_upstream_body(response.iter_content(PROXY_CHUNK_SIZE))
+        return body.decode(response.encoding or 'utf-8', errors='replace')
+    except (requests.exceptions.RequestException, ValueError) as e:
+        if not isinstance(e, ValueError):
+            UPSTREAM_RESPONSES.labels('http', get_upstream_status(e)).inc()
+        logging.error(f"Error fetching the URL content: {e}")
+        return None
+    finally:
+        HTTP_FETCH_SECONDS.observe(time.monotonic() - start)
+
+def read_upstream_body(chunks):
+    """
+    Read a whole upstream body.
+
+    :param chunks: An iterator of the chunks of the body.
+    :return: The body; raises ValueError if it exceeds MAX_PROXY_BODY_SIZE.
+    """
+    body = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > MAX_PROXY_BODY_SIZE:
+            raise ValueError(f"Body exceeds the maximum of {MAX_PROXY_BODY_SIZE} bytes")
+        body.append(chunk)
+    return b''.join(body)
+
+def is_encoded(headers):
+    """
+    Whether an upstream body has a Content-Encoding, e.g. from an upstream that ignored
+    Accept-Encoding: identity.
+    """
+    return headers.get('Content-Encoding', 'identity').strip().lower() != 'identity'
+
+def sniff_json(chunk):
+    """
+    Whether a body starting with the chunk can be token metadata: a JSON object or array.
+    """
+    return chunk.lstrip()[:1] in (b'{', b'[')
+
+def stream_upstream_response(response, on_complete=None, validate_json=False):
+    """
+    Build a Flask response forwarding the body of an upstream response in chunks, with its
+    content and caching headers. Only unencoded bodies with a Content-Length, which
+    open_upstream_stream checked against MAX_PROXY_BODY_SIZE, are streamed as is: the others
+    are read, and decoded, up to the limit first, so that a body too large is refused instead
+    of cut short after a 200 and clients never get compressed bytes without their encoding.
+
+    :param response: The streamed requests.Response.
+    :param on_complete: Optional callable receiving the whole body once it was forwarded.
+    :param validate_json: Whether the body must be JSON: a buffered body is parsed, and the
+                          first chunk of a streamed one sniffed, before the status is sent.
+    :return: The Flask Response; raises ValueError if the body is too large or not JSON, or
+             the error reading it from upstream.
+    """
+    headers = {name: response.headers[name] for name in PASSTHROUGH_HEADERS if name in response.headers}
+    encoded = is_encoded(response.headers)
+    buffered = encoded or 'Content-Length' not in response.headers
+    if buffered:
+        # The length of the buffered body is set by Flask
+        headers.pop('Content-Length', None)
+    chunks = response.raw.stream(PROXY_CHUNK_SIZE, decode_content=encoded)
+    try:
+        if buffered:
+            body = read_upstream_body(chunks)
+            if validate_json:
+                json.loads(body)
+        else:
+            first = next(chunks, b'')
+            if validate_json and not sniff_json(first):
+                raise ValueError(f"Content of {response.url} is not JSON")
+    except Exception:
+        response.close()
+        raise
+
+    if buffered:
+        response.close()
+        if on_complete:
+            on_complete(body)
+        return Response(body, headers=headers, content_type=headers.get('Content-Type'))
+
+    def generate():
+        size = len(first)
+        body = [first] if on_complete else None
+        try:
+            yield first
+            for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_PROXY_BODY_SIZE:
+                    logging.error(f"Body of {response.url} exceeds the maximum of {MAX_PROXY_BODY_SIZE} bytes, truncated")
+                    return
+                if body is not None:
+                    body.append(chunk)
+                yield chunk
+            if on_complete:
+                on_complete(b''.join(body))
+        finally:
+            response.close()
+
+    return Response(generate(), headers=headers, content_type=headers.get('Content-Type'))
+
+def is_valid_ipfs(token_uri):
+    return token_uri.startswith('ipfs://')
+
+_gateway_health = {}
+_gateway_limiters = {}
+_gateway_health_lock = threading.Lock()
+_ipfs_executor = ThreadPoolExecutor(max_workers=IPFS_FETCH_WORKERS, thread_name_prefix='ipfs')
+
+def get_gateway_health(gateway_url):
+    with _gateway_health_lock:
+        health = _gateway_health.get(gateway_url)
+        if health is None:
+            health = _gateway_health[gateway_url] = EndpointHealth(gateway_url)
+        return health
+
+def get_gateway_limiter(gateway):
+    """
+    Get the limiter of an IPFS gateway, created on first use with the limits of its entry.
+    """
+    gateway_url = gateway.get("url")
+    with _gateway_health_lock:
+        limiter = _gateway_limiters.get(gateway_url)
+        if limiter is None:
+            limiter = _gateway_limiters[gateway_url] = UpstreamLimiter(
+                gateway_url, 'ipfs', *get_gateway_limits(gateway))
+        return limiter
+
+def get_gateway_limits(gateway):
+    return gateway.get("rateLimit"), gateway.get("rateBurst"), gateway.get("maxInFlight")
+
+def refresh_gateway_limiters(ipfs_gateways):
+    """
+    Drop the limiters of the gateways whose limits changed or that were removed in a reloaded
+    gateway configuration; they are created again with the new limits on next use.
+
+    :param ipfs_gateways: The new gateway entries.
+    """
+    limits = {gateway.get("url"): get_gateway_limits(gateway) for gateway in ipfs_gateways}
+    with _gateway_health_lock:
+        for gateway_url, limiter in list(_gateway_limiters.items()):
+            if limits.get(gateway_url) != limiter.settings:
+                del _gateway_limiters[gateway_url]
+
+def order_ipfs_gateways(ipfs_gateways):
+    """
+    Order the gateways by observed latency, keeping the configured order for gateways that
+    have not been measured yet and moving the ones with an open breaker to the end.
+
+    :param ipfs_gateways: The gateway entries as loaded from the configuration.
+    :return: The reordered list of gateway entries.
+    """
+    def sort_key(indexed_gateway):
+        index, gateway = indexed_gateway
+        health = get_gateway_health(gateway.get("url"))
+        # Expected cost of a fetch: a gateway that often fails costs a hedge on top of its latency
+        return (not health.is_available(), health.sort_key() + health.error_rate() * FAILURE_PENALTY, index)
+
+    return [gateway for _, gateway in sorted(enumerate(ipfs_gateways), key=sort_key)]
+
+def get_hedge_delay(gateway):
+    p95 = get_gateway_health(gateway.get("url")).latency_percentile(0.95)
+    if p95 is not None:
+        return p95
+    return float(gateway.get("hedgeDelay", DEFAULT_IPFS_HEDGE_DELAY))
+
+def fetch_from_ipfs_gateway(gateway, cid, stream=False):
+    """
+    Fetch the JSON content of a CID from a single gateway, recording its latency.
+
+    :param gateway: The gateway entry as loaded from the configuration.
+    :param cid: The CID, with an optional path.
+    :param stream: Return the response as soon as its headers arrive instead of its parsed content.
+    :return: The parsed JSON content, or the streamed response; raises if the gateway fails,
+             or UpstreamThrottled without a request if it is over its limits.
+    """
+    ipfs_gateway_url = gateway.get("url")
+    # example of suffix = "?pinataGatewayToken=2z....Nk" 
+    apiKeySuffix = gateway.get("apiKeySuffix")
+    full_uri = f'{ipfs_gateway_url}{cid}{apiKeySuffix}'
+    limiter = get_gateway_limiter(gateway)
+    if not limiter.try_acquire():
+        raise UpstreamThrottled(limiter)
+    start = time.monotonic()
+    try:
+        timeout = float(gateway.get("timeout", DEFAULT_IPFS_GATEWAY_TIMEOUT))
+        if stream:
+            content = open_upstream_stream(full_uri, timeout, passthrough=True)
+        else:
+            response = requests.get(full_uri, timeout=timeout)
+            response.raise_for_status()  # Raises HTTPError for unsuccessful status codes
+            content = response.json()
+        status = (content if stream else response).status_code
+    except Exception as err:
+        record_gateway_fetch(ipfs_gateway_url, time.monotonic() - start, error=err)
+        raise
+    finally:
+        limiter.release()
+    record_gateway_fetch(ipfs_gateway_url, time.monotonic() - start, status=status)
+    return content
+
+def record_gateway_fetch(ipfs_gateway_url, latency, status=None, error=None):
+    """
+    Record a fetch from an IPFS gateway in its health and the metrics.
+
+    :param ipfs_gateway_url: The URL of the gateway.
+    :param latency: The duration of the fetch in seconds.
+    :param status: The HTTP status of a successful fetch.
+    :param error: The exception a failed fetch raised.
+    """
+    health = get_gateway_health(ipfs_gateway_url)
+    IPFS_FETCH_SECONDS.labels(get_upstream_host(ipfs_gateway_url)).observe(latency)
+    if error is not None:
+        health.record_failure()
+        UPSTREAM_RESPONSES.labels('ipfs', get_upstream_status(error)).inc()
+        logging.error(f"An error occurred with {ipfs_gateway_url}: {error}")
+        return
+    health.record_success(latency)
+    UPSTREAM_RESPONSES.labels('ipfs', str(status)).inc()
+
+def race_ipfs_gateways(cid, stream=False):
+    """
+    Race the configured gateways for a CID. The fastest gateway is asked first and each
+    following one is fired when the previous ones have not answered within the hedge delay,
+    or as soon as one of them fails or is over its limits. The first successful answer wins;
+    gateways not started yet are cancelled and the ones in flight are left to finish within
+    their own timeout.
+
+    :param cid: The CID, with an optional path.
+    :param stream: Race for the first streamed response instead of the first parsed JSON.
+    :return: The winning answer of fetch_from_ipfs_gateway, or None if every gateway failed.
+             Raises a ServiceUnavailable if the gateways that did not fail are over their limits.
+    """
+    ipfs_gateways = order_ipfs_gateways(get_ipfs_gateways())
+    pending = set()
+    throttled = []
+    next_gateway = 0
+    while next_gateway < len(ipfs_gateways) or pending:
+        hedge_delay = None
+        if next_gateway < len(ipfs_gateways):
+            gateway = ipfs_gateways[next_gateway]
+            pending.add(_ipfs_executor.submit(fetch_from_ipfs_gateway, gateway, cid, stream))
+            next_gateway += 1
+            if next_gateway < len(ipfs_gateways):
+                hedge_delay = get_hedge_delay(gateway)
+
+        done, pending = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+        winners = [future for future in done if future.exception() is None]
+        if winners:
+            if stream:
+                for other in winners[1:]:
+                    close_streamed_response(other)
+            for other in pending:
+                other.cancel()
+                if stream:
+                    other.add_done_callback(close_streamed_response)
+            return winners[0].result()
+        throttled.extend(
+            future.exception().limiter for future in done if isinstance(future.exception(), UpstreamThrottled))
+
+    if throttled:
+        logging.error("Failed to fetch data from IPFS, gateways are over their limits.")
+        raise throttled_error(throttled)
+    logging.error("Failed to fetch data from all IPFS gateways.")
+    return None
+
+def close_streamed_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def get_cid(token_uri):
+    """
+    Get the CID, with its optional path, of an ipfs:// URI.
+    """
+    # token_uri if forced to start with ipfs:// outside this method
+    return token_uri.split('ipfs://')[1]
+
+def fetch_ipfs_content(token_uri):
+    """
+    Fetch the JSON content of an ipfs:// URI, racing the configured gateways.
+
+    :param token_uri: The ipfs:// URI.
+    :return: The parsed JSON content, or None if every gateway failed.
+    """
+    return race_ipfs_gateways(get_cid(token_uri))
+
+
+class CIDCache:
+    """
+    Two-tier cache of IPFS content keyed by CID: a size-bounded LRU in memory backed by an
+    SQLite file. Entries never expire since content addressed by a CID cannot change; they
+    are only evicted, least recently used first, to honour the entry and byte limits.
+    """
+
+    def __init__(self, path=None, max_entries=IPFS_CACHE_MAX_ENTRIES, max_bytes=IPFS_CACHE_MAX_BYTES,
+                 disk_max_entries=IPFS_CACHE_DISK_MAX_ENTRIES, disk_max_bytes=IPFS_CACHE_DISK_MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.counters = {"memoryHits": 0, "diskHits": 0, "misses": 0, "memoryEvictions": 0, "diskEvictions": 0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads; WAL lets the workers of the
+        # host read while another one writes.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS content "
+                    "(cid TEXT PRIMARY KEY, data TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS content_accessed ON content (accessed)")
+                # Running totals of the content table, kept by triggers so that concurrent
+                # writers on the same file never apply a delta computed from a stale read
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS totals "
+                    "(id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER NOT NULL, bytes INTEGER NOT NULL)"
+                )
+                connection.execute(
+                    "INSERT OR IGNORE INTO totals SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM content")
+                connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS content_insert AFTER INSERT ON content BEGIN "
+                    "UPDATE totals SET entries = entries + 1, bytes = bytes + NEW.size; END")
+                connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS content_update AFTER UPDATE OF size ON content BEGIN "
+                    "UPDATE totals SET bytes = bytes + NEW.size - OLD.size; END")
+                connection.execute(
+                    "CREATE TRIGGER IF NOT EXISTS content_delete AFTER DELETE ON content BEGIN "
+                    "UPDATE totals SET entries = entries - 1, bytes = bytes - OLD.size; END")
+            self._local.connection = connection
+        return connection
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def get(self, cid):
+        """
+        Get the cached content of a CID.
+
+        :param cid: The CID, with an optional path.
+        :return: The content if cached, otherwise None.
+        """
+        with self._lock:
+            data = self.memory.get(cid)
+            if data is not None:
+                self.memory.move_to_end(cid)
+                self.counters["memoryHits"] += 1
+                IPFS_CACHE_LOOKUPS.labels('memory').inc()
+                return json.loads(data)
+
+        data = self._disk_get(cid)
+        if data is None:
+            self._count("misses")
+            IPFS_CACHE_LOOKUPS.labels('miss').inc()
+            return None
+        self._count("diskHits")
+        IPFS_CACHE_LOOKUPS.labels('disk').inc()
+        self._memory_put(cid, data)
+        return json.loads(data)
+
+    def put(self, cid, content):
+        """
+        Cache the content of a CID in both tiers.
+
+        :param cid: The CID, with an optional path.
+        :param content: The JSON-serializable content.
+        """
+        data = json.dumps(content)
+        self._memory_put(cid, data)
+        self._disk_put(cid, data)
+
+    def _memory_put(self, cid, data):
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self.memory.pop(cid, None)
+            if previous is not None:
+                self.memory_bytes -= len(previous)
+            self.memory[cid] = data
+            self.memory_bytes += size
+            while len(self.memory) > self.max_entries or self.memory_bytes > self.max_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+                self.counters["memoryEvictions"] += 1
+
+    def _disk_get(self, cid):
+        if not self.path:
+            return None
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT data, accessed FROM content WHERE cid = ?", (cid,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > IPFS_CACHE_DISK_ACCESS_RESOLUTION:
+                with connection:
+                    connection.execute("UPDATE content SET accessed = ? WHERE cid = ?", (now, cid))
+            return row[0]
+        except sqlite3.Error as e:
+            logging.error(f"Error reading {cid} from the IPFS cache: {e}")
+            return None
+
+    def _disk_put(self, cid, data):
+        if not self.path:
+            return
+        size = len(data)
+        if size > self.disk_max_bytes:
+            return
+        try:
+            connection = self._connection()
+            with connection:
+                # An upsert rather than INSERT OR REPLACE, whose implicit delete fires no trigger
+                connection.execute(
+                    "INSERT INTO content (cid, data, size, accessed) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (cid) DO UPDATE SET data = excluded.data, size = excluded.size, accessed = excluded.accessed",
+                    (cid, data, size, time.time()),
+                )
+                entries, total_bytes = connection.execute("SELECT entries, bytes FROM totals").fetchone()
+                evictions = 0
+                if entries > self.disk_max_entries or total_bytes > self.disk_max_bytes:
+                    evictions = self._disk_evict(connection, cid, entries, total_bytes)
+            if evictions:
+                with self._lock:
+                    self.counters["diskEvictions"] += evictions
+        except sqlite3.Error as e:
+            logging.error(f"Error writing {cid} to the IPFS cache: {e}")
+
+    def _disk_evict(self, connection, cid, entries, total_bytes):
+        """
+        Evict the least recently used entries but the one just written, down to
+        IPFS_CACHE_DISK_EVICTION_TARGET of the limits, within the caller's transaction.
+
+        :return: The number of evicted entries.
+        """
+        target_entries = int(self.disk_max_entries * IPFS_CACHE_DISK_EVICTION_TARGET)
+        target_bytes = int(self.disk_max_bytes * IPFS_CACHE_DISK_EVICTION_TARGET)
+        evicted = []
+        cursor = connection.execute("SELECT cid, size FROM content WHERE cid != ? ORDER BY accessed", (cid,))
+        for evicted_cid, evicted_size in cursor:
+            if entries <= target_entries and total_bytes <= target_bytes:
+                break
+            evicted.append((evicted_cid,))
+            entries -= 1
+            total_bytes -= evicted_size
+        cursor.close()
+        connection.executemany("DELETE FROM content WHERE cid = ?", evicted)
+        return len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+            self.memory_bytes = 0
+        if self.path:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM content")
+
+    def stats(self):
+        with self._lock:
+            stats = {**self.counters, "memoryEntries": len(self.memory), "memoryBytes": self.memory_bytes}
+        if self.path:
+            try:
+                entries, total_bytes = self._connection().execute("SELECT entries, bytes FROM totals").fetchone()
+                stats.update({"diskEntries": entries, "diskBytes": total_bytes})
+            except sqlite3.Error as e:
+                logging.error(f"Error reading the IPFS cache stats: {e}")
+        return stats
+
+ipfs_cache = CIDCache(IPFS_CACHE_PATH or None)
+
+def get_ipfs_content(token_uri):
+    """
+    Get the content of an ipfs:// URI from the CID cache, fetching and caching it on a miss
+    once admitted by the lookup queue.
+
+    :param token_uri: The ipfs:// URI.
+    :return: The content, or None if it could not be fetched.
+    """
+    cid = get_cid(token_uri)
+    content = ipfs_cache.get(cid)
+    if content is not None:
+        return content
+    def fetch_and_cache():
+        with lookup_queue.slot():
+            content = fetch_ipfs_content(token_uri)
+        if content is not None:
+            ipfs_cache.put(cid, content)
+        return content
+    return content_flight.do(token_uri, fetch_and_cache)
+
+
+@app.errorhandler(Exception)
+def handle_exception(e):
+    """Return JSON instead of HTML for HTTP errors."""
+    response = e.get_response()
+    response.data = json.dumps({
+        "code": e.code,
+        "name": e.name,
+        "description": e.description,
+    })
+    response.content_type = "application/json"
+    return response
+
+@app.route('/admin/status', methods=['GET'])
+def admin_status():
+    check_admin_token()
+    with _gateway_health_lock:
+        gateways = list(_gateway_health.values())
+        limiters = dict(_gateway_limiters)
+    return jsonify({
+        "rpcClients": get_rpc_client_stats(),
+        "ipfsGateways": [
+            {"host": get_upstream_host(health.url), **health.stats(), "limits": limiters[health.url].stats() if health.url in limiters else None}
+            for health in gateways
+        ],
+        "admission": get_admission_stats(),
+        "ipfsCache": ipfs_cache.stats(),
+        "tokenUriCache": token_uri_cache.stats(),
+        "coalescing": get_coalescing_stats(),
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/robots.txt')
+@app.route('/favicon.ico')
+def static_from_root():
+    return send_from_directory(app.static_folder, request.path[1:])
+
+def abort_content_unavailable(token_uri):
+    """
+    Abort with 502 when the content of an IPFS or URL token URI cannot be fetched.
+    """
+    source = 'IPFS' if is_valid_ipfs(token_uri) else 'URL'
+    abort(502, description=f"Failed to fetch data from {source} {token_uri}")
+
+def fetch_token_uri_content(token_uri):
+    """
+    Get the content a token URI points to: the JSON stored in IPFS for ipfs:// URIs, the
+    server response for URLs, else the raw token URI. Aborts with 502 if the content cannot
+    be fetched.
+
+    :param token_uri: The token URI.
+    :return: A tuple with the content and whether it has to be returned as JSON.
+    """
+    if is_valid_ipfs(token_uri):
+        token_uri_result = get_ipfs_content(token_uri)
+        if not token_uri_result:
+            abort_content_unavailable(token_uri)
+        return token_uri_result, True
+
+    if is_valid_url(token_uri):
+        def fetch():
+            with lookup_queue.slot():
+                return fetch_url_content(token_uri)
+        token_uri_result = content_flight.do(token_uri, fetch)
+        if not token_uri_result:
+            abort_content_unavailable(token_uri)
+        return token_uri_result, False
+
+    # If the URI is not IPFS nor a valid URL, just return the content of token_uri
+    return {"token_uri": token_uri}, True
+
+def get_token_uri_kind(token_uri):
+    if is_valid_ipfs(token_uri):
+        return 'ipfs'
+    if is_valid_url(token_uri):
+        return 'url'
+    return 'raw'
+
+def get_cache_control(chain_id, kind):
+    """
+    Get the Cache-Control of a lookup response.
+
+    :param chain_id: The chain ID of the location.
+    :param kind: The kind of token URI: 'ipfs', 'url' or 'raw'.
+    :return: The "cacheControl" of the chain entry for the kind, else its default.
+    """
+    settings = get_chain_settings(chain_id) if chain_id is not None else {}
+    return settings.get('cacheControl', {}).get(kind, DEFAULT_CACHE_CONTROL[kind])
+
+def content_etag(content):
+    return hashlib.sha256(content).hexdigest()[:32]
+
+def get_token_uri_etag(token_uri):
+    """
+    Get the ETag of the content of a token URI when it is known without fetching the
+    content: the CID (and path) for IPFS content, which is immutable, and a hash of the token
+    URI itself for raw results. It is sent as a weak validator, since the same content may be
+    served as the upstream bytes or serialized again from the cache.
+
+    :param token_uri: The token URI.
+    :return: The unquoted ETag, or None for URLs, whose ETag is a hash of their content.
+    """
+    kind = get_token_uri_kind(token_uri)
+    if kind == 'ipfs':
+        return get_cid(token_uri)
+    if kind == 'raw':
+        return content_etag(token_uri.encode())
+    return None
+
+def add_cache_headers(response, etag, cache_control, keep_upstream=False):
+    """
+    Set the ETag and Cache-Control of a lookup response, and turn it into a 304 when the
+    request's If-None-Match has the ETag.
+
+    :param response: The Flask Response.
+    :param etag: The unquoted ETag, or None to keep the response's own.
+    :param cache_control: The Cache-Control to set.
+    :param keep_upstream: Whether a Cache-Control forwarded from upstream takes precedence.
+    :return: The response to send.
+    """
+    if not (keep_upstream and 'Cache-Control' in response.headers):
+        response.headers['Cache-Control'] = cache_control
+    if etag is None:
+        return response
+    response.set_etag(etag, weak=True)
+    if request.if_none_match.contains_weak(etag):
+        response.close()
+        return not_modified_response(etag, response.headers['Cache-Control'])
+    return response
+
+def not_modified_response(etag, cache_control):
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def cache_streamed_content(token_uri, body):
+    """
+    Add the streamed body of an ipfs:// URI to the CID cache, if it is JSON.
+    """
+    try:
+        ipfs_cache.put(get_cid(token_uri), json.loads(body))
+    except ValueError:
+        logging.error(f"Content of {token_uri} is not JSON, not cached")
+
+def stream_token_uri_content(token_uri):
+    """
+    Proxy the content a token URI points to, forwarding the upstream bytes in chunks instead
+    of buffering them. IPFS content already in the CID cache is served from it, and streamed
+    IPFS content is added to it once complete. Aborts with 502 if the content cannot be fetched,
+    is too large, or is IPFS content that is not JSON.
+
+    :param token_uri: The token URI.
+    :return: The Flask Response, or None if the token URI is neither IPFS nor a URL.
+    """
+    if is_valid_ipfs(token_uri):
+        cid = get_cid(token_uri)
+        content = ipfs_cache.get(cid)
+        if content is not None:
+            return jsonify(content)
+        with lookup_queue.slot():
+            response = race_ipfs_gateways(cid, stream=True)
+        if response is None:
+            abort_content_unavailable(token_uri)
+        try:
+            return stream_upstream_response(
+                response, on_complete=partial(cache_streamed_content, token_uri), validate_json=True)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, ValueError) as e:
+            logging.error(f"Error reading the IPFS content: {e}")
+            abort_content_unavailable(token_uri)
+
+    if is_valid_url(token_uri):
+        start = time.monotonic()
+        try:
+            with lookup_queue.slot():
+                response = open_upstream_stream(token_uri, URL_FETCH_TIMEOUT, passthrough=True)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            UPSTREAM_RESPONSES.labels('http', get_upstream_status(e)).inc()
+            logging.error(f"Error fetching the URL content: {e}")
+            abort_content_unavailable(token_uri)
+        finally:
+            HTTP_FETCH_SECONDS.observe(time.monotonic() - start)
+        UPSTREAM_RESPONSES.labels('http', str(response.status_code)).inc()
+        try:
+            return stream_upstream_response(response)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, ValueError) as e:
+            logging.error(f"Error reading the URL content: {e}")
+            abort_content_unavailable(token_uri)
+
+    return None
+
+def parse_batch_request(body):
+    """
+    Get the universal locations requested in a batch body, which has either a list of
+    "locations" or a "location" prefix down to AccountKey20 plus a list of "tokenIds" or an
+    inclusive "fromTokenId"/"toTokenId" range. Aborts with 400 if the body is invalid.
+
+    :param body: The parsed JSON body.
+    :return: A list of universal location paths.
+    """
+    if not isinstance(body, dict):
+        abort(400, description="Batch body must be a JSON object.")
+    if "locations" in body:
+        locations = body["locations"]
+        if not isinstance(locations, list) or not all(isinstance(location, str) for location in locations):
+            abort(400, description="'locations' must be a list of strings.")
+    elif "location" in body:
+        prefix = str(body["location"]).strip('/')
+        if "tokenIds" in body:
+            token_ids = body["tokenIds"]
+            if not isinstance(token_ids, list):
+                abort(400, description="'tokenIds' must be a list.")
+        else:
+            try:
+                first, last = int(body["fromTokenId"]), int(body["toTokenId"])
+            except (KeyError, TypeError, ValueError):
+                abort(400, description="Either 'tokenIds' or 'fromTokenId' and 'toTokenId' must be provided.")
+            if last - first + 1 > BATCH_MAX_ITEMS:
+                abort(400, description=f"Batches are limited to {BATCH_MAX_ITEMS} items.")
+            token_ids = range(first, last + 1)
+        locations = [f"{prefix}/GeneralKey({token_id})" for token_id in token_ids]
+    else:
+        abort(400, description="Either 'locations' or 'location' must be provided.")
+
+    if len(locations) > BATCH_MAX_ITEMS:
+        abort(400, description=f"Batches are limited to {BATCH_MAX_ITEMS} items.")
+    return locations
+
+def iter_batch_token_uris(locations):
+    """
+    Resolve the token URIs of many universal locations, reading the tokenURI cache first and
+    grouping the misses by chain into JSON-RPC batches of the chain's "rpcBatchSize" calls.
+    Results are yielded as soon as they are known: first the cache hits and invalid locations,
+    then one chunk after another.
+
+    :param locations: A list of universal location paths.
+    :return: A generator of lists of (index, result) pairs, where the result is the token URI
+             or the HTTPException describing why it could not be resolved.
+    """
+    known = []
+    chains = {}
+    groups = {}
+    for index, location in enumerate(locations):
+        try:
+            ul = get_ul_fields(location)
+            if ul.chain not in chains:
+                chains[ul.chain] = get_chain_info(*ul.chain)
+            rpc_urls, chain_id = chains[ul.chain]
+            if not rpc_urls:
+                abort(404, description="RPC URLs not found.")
+        except HTTPException as e:
+            known.append((index, e))
+            continue
+        account_key, general_key = ul.AccountKey20, ul.GeneralKey
+
+        key = ul.key
+        entry = get_cached_token_uri(key, rpc_urls, account_key, general_key, chain_id)
+        if entry is not None:
+            known.append((index, entry["uri"] if entry["uri"] is not None else NotFound(description="Token URI not found")))
+            continue
+        groups.setdefault((chain_id, tuple(rpc_urls)), []).append((index, key, account_key, general_key))
+    if known:
+        yield known
+
+    for (chain_id, rpc_urls), lookups in groups.items():
+        settings = get_chain_settings(chain_id) if chain_id is not None else {}
+        chunk_size = int(settings.get('rpcBatchSize', DEFAULT_RPC_BATCH_SIZE))
+        for offset in range(0, len(lookups), chunk_size):
+            chunk = lookups[offset:offset + chunk_size]
+            try:
+                with lookup_queue.slot():
+                    resolved = resolve_token_uris_batch(
+                        list(rpc_urls), [(account_key, general_key) for _, _, account_key, general_key in chunk], chain_id)
+            except HTTPException as e:
+                resolved = [e] * len(chunk)
+            yield [(index, store_batch_token_uri(locations[index], key, token_uri, chain_id))
+                   for (index, key, _, _), token_uri in zip(chunk, resolved)]
+
+def store_batch_token_uri(location, key, token_uri, chain_id):
+    """
+    Cache the outcome of one batch lookup and turn it into the batch item's token URI or error.
+    """
+    if isinstance(token_uri, HTTPException):
+        return token_uri
+    if isinstance(token_uri, Exception) and not isinstance(token_uri, TokenNotFound):
+        logging.error(f"Failed to resolve {location}: {token_uri}")
+        token_uri = None
+    token_uri = store_resolved_token_uri(key, token_uri, chain_id)
+    return token_uri if token_uri else NotFound(description="Token URI not found")
+
+def resolve_batch_token_uris(locations):
+    """
+    Resolve the token URIs of many universal locations, see iter_batch_token_uris.
+
+    :param locations: A list of universal location paths.
+    :return: A list with, for each location, the token URI or the HTTPException describing
+             why it could not be resolved.
+    """
+    results = [None] * len(locations)
+    for resolved in iter_batch_token_uris(locations):
+        for index, token_uri in resolved:
+            results[index] = token_uri
+    return results
+
+def get_batch_item(location, token_uri):
+    """
+    Build the result of one batch item, fetching its content.
+    """
+    if isinstance(token_uri, HTTPException):
+        return {"location": location, "error": {"code": token_uri.code, "description": token_uri.description}}
+    try:
+        content, _ = fetch_token_uri_content(token_uri)
+    except HTTPException as e:
+        return {"location": location, "tokenUri": token_uri, "error": {"code": e.code, "description": e.description}}
+    return {"location": location, "tokenUri": token_uri, "content": content}
+
+@app.route('/batch', methods=['POST'])
+def handle_batch_request():
+    """
+    Resolve many universal locations at once. Results are returned in request order as
+    {"results": [...]}, or streamed as NDJSON in completion order when the client accepts
+    application/x-ndjson or passes ?stream=1.
+    """
+    locations = parse_batch_request(request.get_json(silent=True))
+    stream = request.args.get('stream') == '1' or request.accept_mimetypes.best == 'application/x-ndjson'
+    if not stream:
+        token_uris = resolve_batch_token_uris(locations)
+        futures = [
+            _batch_executor.submit(get_batch_item, location, token_uri)
+            for location, token_uri in zip(locations, token_uris)
+        ]
+        return jsonify({"results": [future.result() for future in futures]})
+
+    # Chunks are resolved in the background, and the content of each item is fetched as soon
+    # as its token URI is known, so the first items are written out while the later chunks are
+    # still being resolved
+    items = queue.Queue()
+
+    def resolve():
+        submitted = set()
+        try:
+            for resolved in iter_batch_token_uris(locations):
+                for index, token_uri in resolved:
+                    submitted.add(index)
+                    future = _batch_executor.submit(get_batch_item, locations[index], token_uri)
+                    future.add_done_callback(items.put)
+        except Exception as e:
+            logging.error(f"Failed to resolve batch: {e}")
+            for index, location in enumerate(locations):
+                if index not in submitted:
+                    items.put({"location": location, "error": {"code": 500, "description": "Failed to resolve the token URI."}})
+
+    threading.Thread(target=resolve, name='batch-resolve', daemon=True).start()
+
+    def generate():
+        for _ in locations:
+            item = items.get()
+            yield json.dumps(item.result() if isinstance(item, Future) else item) + '\n'
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def call_with_failover(rpc_urls, chain_id, call):
+    """
+    Run a call against the RPC nodes of a chain, fastest healthy node within its limits first,
+    falling through to the next node if it fails.
+
+    :param rpc_urls: A list of RPC URLs.
+    :param chain_id: The chain ID of the RPC URLs.
+    :param call: Callable receiving an RPCClient.
+    :return: The result of the first successful call; raises the last error if every node failed.
+    """
+    error = ConnectionError("All RPC URLs are unavailable, circuit breakers are open.")
+    for client in order_rpc_clients(rpc_urls, chain_id):
+        if not client.limiter.try_acquire():
+            error = UpstreamThrottled(client.limiter)
+            continue
+        if not client.health.allow_request():
+            client.limiter.release()
+            continue
+        start = time.monotonic()
+        try:
+            result = call(client)
+        except Exception as e:
+            client.health.record_failure()
+            logging.error(f"Error occurred with RPC URL {client.rpc_url}: {e}")
+            error = e
+            continue
+        finally:
+            client.limiter.release()
+        client.health.record_success(time.monotonic() - start)
+        return result
+    raise error
+
+def scan_transfer_token_ids(rpc_urls, chain_id, contract_address, from_block, to_block=None, job=None):
+    """
+    Enumerate the token IDs of a contract from its ERC-721 Transfer logs, scanning
+    WARMUP_LOG_BLOCK_RANGE blocks per eth_getLogs call.
+
+    :param rpc_urls: A list of RPC URLs of the chain.
+    :param chain_id: The chain ID of the RPC URLs.
+    :param contract_address: The address of the contract.
+    :param from_block: The first block to scan.
+    :param to_block: The last block to scan, the latest one if None.
+    :param job: The WarmUpJob to pace, report progress to and stop when cancelled.
+    :return: The token IDs, as strings, in order of first appearance.
+    """
+    if to_block is None:
+        to_block = call_with_failover(rpc_urls, chain_id, lambda client: client.web3.eth.block_number)
+    address = Web3.toChecksumAddress(contract_address)
+    token_ids = {}
+    for start in range(from_block, to_block + 1, WARMUP_LOG_BLOCK_RANGE):
+        if job is not None and job.cancelled.is_set():
+            break
+        end = min(start + WARMUP_LOG_BLOCK_RANGE - 1, to_block)
+        if job is not None:
+            job.rpc_limiter.acquire()
+        logs = call_with_failover(rpc_urls, chain_id, lambda client: client.web3.eth.get_logs(
+            {"address": address, "fromBlock": start, "toBlock": end, "topics": [TRANSFER_EVENT_TOPIC]}))
+        for log in logs:
+            # ERC-20 Transfers have no indexed token ID
+            if len(log["topics"]) == 4:
+                token_ids[str(int.from_bytes(HexBytes(log["topics"][3]), 'big'))] = None
+        if len(token_ids) > WARMUP_MAX_TOKENS:
+            raise ValueError(f"Warm-ups are limited to {WARMUP_MAX_TOKENS} tokens.")
+        if job is not None:
+            job.count("scannedBlocks", end - start + 1)
+    return list(token_ids)
+
+class WarmUpJob:
+    """
+    Pre-resolves the tokenURIs of tokens of a contract and fetches their IPFS content ahead of
+    the traffic, filling the tokenURI and IPFS caches. Tokens are resolved WARMUP_CHUNK_SIZE at
+    a time with JSON-RPC batches, and contents fetched with at most "concurrency" requests
+    in flight, paced to "rpcRate" eth_calls and "contentRate" fetches per second.
+
+    :param prefix: The universal location prefix down to AccountKey20.
+    :param token_ids: The token IDs to warm up, or None to scan the Transfer logs.
+    :param from_block: The first block of the Transfer logs to scan.
+    :param to_block: The last block of the Transfer logs to scan, the latest one if None.
+    """
+
+    def __init__(self, prefix, token_ids=None, from_block=None, to_block=None,
+                 concurrency=WARMUP_DEFAULT_CONCURRENCY, rpc_rate=WARMUP_DEFAULT_RPC_RATE,
+                 content_rate=WARMUP_DEFAULT_CONTENT_RATE):
+        self.id = uuid.uuid4().hex[:12]
+        self.prefix = prefix
+        self.token_ids = token_ids
+        self.from_block = from_block
+        self.to_block = to_block
+        self.concurrency = concurrency
+        self.rpc_limiter = TokenBucket(rpc_rate)
+        self.content_limiter = TokenBucket(content_rate)
+        self.state = 'pending'
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.progress = {
+            "tokens": 0, "resolved": 0, "notFound": 0, "failed": 0,
+            "contentFetched": 0, "contentFailed": 0, "contentSkipped": 0, "scannedBlocks": 0,
+        }
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.progress[counter] += amount
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self, on_progress=None):
+        """
+        Run the warm-up to completion.
+
+        :param on_progress: Optional callable receiving the job after every chunk of tokens.
+        """
+        self.state = 'running'
+        self.started_at = time.time()
+        try:
+            location = parse_universal_location(f"{self.prefix}/GeneralKey(0)")
+            rpc_urls, chain_id = get_chain_info(*location.chain)
+            if not rpc_urls:
+                raise NotFound(description="RPC URLs not found.")
+            token_ids = self.token_ids
+            if token_ids is None:
+                token_ids = scan_transfer_token_ids(
+                    rpc_urls, chain_id, location.AccountKey20, self.from_block, self.to_block, self)
+            self.count("tokens", len(token_ids))
+
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='warmup') as executor:
+                for offset in range(0, len(token_ids), WARMUP_CHUNK_SIZE):
+                    if self.cancelled.is_set():
+                        break
+                    chunk = token_ids[offset:offset + WARMUP_CHUNK_SIZE]
+                    self.rpc_limiter.acquire(len(chunk))
+                    token_uris = resolve_batch_token_uris([f"{self.prefix}/GeneralKey({token_id})" for token_id in chunk])
+                    list(executor.map(self.fetch_content, token_uris))
+                    if on_progress:
+                        on_progress(self)
+            self.state = 'cancelled' if self.cancelled.is_set() else 'done'
+        except Exception as e:
+            self.state = 'failed'
+            self.error = e.description if isinstance(e, HTTPException) else str(e)
+            logging.error(f"Warm-up {self.id} of {self.prefix} failed: {self.error}")
+        finally:
+            self.finished_at = time.time()
+
+    def fetch_content(self, token_uri):
+        if isinstance(token_uri, NotFound):
+            self.count("notFound")
+            return
+        if isinstance(token_uri, HTTPException):
+            self.count("failed")
+            return
+        self.count("resolved")
+        if not is_valid_ipfs(token_uri):
+            # Only IPFS content is cached
+            self.count("contentSkipped")
+            return
+        if self.cancelled.is_set():
+            return
+        self.content_limiter.acquire()
+        try:
+            content = get_ipfs_content(token_uri)
+        except HTTPException as e:
+            # Shed under load or over the gateway limits
+            logging.error(f"Failed to warm up {token_uri}: {e.description}")
+            content = None
+        self.count("contentFetched" if content else "contentFailed")
+
+    def stats(self):
+        with self._lock:
+            progress = dict(self.progress)
+        return {
+            "id": self.id,
+            "location": self.prefix,
+            "state": self.state,
+            "error": self.error,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+            **progress,
+        }
+
+def get_warmup_prefix(body):
+    """
+    Get the universal location prefix of a warm-up request, given either as a "location"
+    prefix down to AccountKey20, or as a "chain" (Name or ChainId) and a "contract" address.
+    """
+    if "location" in body:
+        return str(body["location"]).strip('/')
+    chain, contract = body.get("chain"), body.get("contract")
+    if chain is None or contract is None:
+        abort(400, description="Either 'location' or 'chain' and 'contract' must be provided.")
+    for entry in consensus_registry.get()["entries"]:
+        if str(chain) in (entry.get("Name"), entry["ChainId"]):
+            return (f"GlobalConsensus({entry['GlobalConsensus']})/Parachain({entry['Parachain']})/"
+                    f"PalletInstance({entry['PalletInstance']})/AccountKey20({contract})")
+    abort(404, description=f"Chain {chain} not found.")
+
+def parse_warmup_request(body):
+    """
+    Build the warm-up job described by a request body, with the location (see
+    get_warmup_prefix), the tokens as a list of "tokenIds", an inclusive
+    "fromTokenId"/"toTokenId" range or a "fromBlock"/"toBlock" range of Transfer logs to scan,
+    and optionally the "concurrency", "rpcRate" and "contentRate". Aborts with 400 if the
+    body is invalid.
+
+    :param body: The parsed JSON body.
+    :return: The WarmUpJob, not started.
+    """
+    if not isinstance(body, dict):
+        abort(400, description="Warm-up body must be a JSON object.")
+    prefix = get_warmup_prefix(body)
+    try:
+        parse_universal_location(f"{prefix}/GeneralKey(0)")
+        token_ids = from_block = to_block = None
+        if "tokenIds" in body:
+            if not isinstance(body["tokenIds"], list):
+                abort(400, description="'tokenIds' must be a list.")
+            token_ids = [str(token_id) for token_id in body["tokenIds"]]
+        elif "fromTokenId" in body:
+            first, last = int(body["fromTokenId"]), int(body["toTokenId"])
+            if last - first + 1 > WARMUP_MAX_TOKENS:
+                abort(400, description=f"Warm-ups are limited to {WARMUP_MAX_TOKENS} tokens.")
+            token_ids = [str(token_id) for token_id in range(first, last + 1)]
+        elif "fromBlock" in body:
+            from_block = int(body["fromBlock"])
+            to_block = int(body["toBlock"]) if body.get("toBlock") is not None else None
+        else:
+            abort(400, description="Either 'tokenIds', 'fromTokenId' and 'toTokenId', or 'fromBlock' must be provided.")
+        settings = {
+            "concurrency": int(body.get("concurrency", WARMUP_DEFAULT_CONCURRENCY)),
+            "rpc_rate": float(body.get("rpcRate", WARMUP_DEFAULT_RPC_RATE)),
+            "content_rate": float(body.get("contentRate", WARMUP_DEFAULT_CONTENT_RATE)),
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        abort(400, description=f"Invalid warm-up request: {e}")
+    if token_ids is not None and len(token_ids) > WARMUP_MAX_TOKENS:
+        abort(400, description=f"Warm-ups are limited to {WARMUP_MAX_TOKENS} tokens.")
+    if not all(0 < value < math.inf for value in settings.values()):
+        abort(400, description="'concurrency', 'rpcRate' and 'contentRate' must be positive.")
+    # Never paced faster than the gateway allows, whatever the request asks for
+    settings["concurrency"] = min(settings["concurrency"], WARMUP_MAX_CONCURRENCY)
+    settings["rpc_rate"] = min(settings["rpc_rate"], WARMUP_MAX_RPC_RATE)
+    settings["content_rate"] = min(settings["content_rate"], WARMUP_MAX_CONTENT_RATE)
+    return WarmUpJob(prefix, token_ids, from_block, to_block, **settings)
+
+_warmup_jobs = OrderedDict()
+_warmup_jobs_lock = threading.Lock()
+
+def start_warmup_job(job):
+    """
+    Run a warm-up job in a background thread, keeping the last WARMUP_MAX_JOBS jobs for
+    progress reports.
+    """
+    with _warmup_jobs_lock:
+        running = sum(1 for other in _warmup_jobs.values() if other.state in ('pending', 'running'))
+        if running >= WARMUP_MAX_RUNNING_JOBS:
+            abort(429, description=f"At most {WARMUP_MAX_RUNNING_JOBS} warm-ups can run at once.")
+        _warmup_jobs[job.id] = job
+        while len(_warmup_jobs) > WARMUP_MAX_JOBS:
+            _warmup_jobs.popitem(last=False)
+    threading.Thread(target=job.run, name=f'warmup-{job.id}', daemon=True).start()
+    return job
+
+def get_warmup_job(job_id):
+    with _warmup_jobs_lock:
+        job = _warmup_jobs.get(job_id)
+    if job is None:
+        abort(404, description=f"Warm-up {job_id} not found.")
+    return job
+
+def check_admin_token():
+    """
+    Abort with 404 if the admin endpoints are disabled, i.e. ADMIN_TOKEN is not set, or with
+    401 if the request does not carry the admin token.
+    """
+    if not ADMIN_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        abort(401, description="Invalid or missing admin token.")
+
+@app.route('/admin/warmup', methods=['POST'])
+def handle_warmup_request():
+    check_admin_token()
+    job = start_warmup_job(parse_warmup_request(request.get_json(silent=True)))
+    return jsonify(job.stats()), 202
+
+@app.route('/admin/warmup', methods=['GET'])
+def list_warmup_jobs():
+    check_admin_token()
+    with _warmup_jobs_lock:
+        jobs = list(_warmup_jobs.values())
+    return jsonify({"jobs": [job.stats() for job in jobs]})
+
+@app.route('/admin/warmup/<job_id>', methods=['GET'])
+def get_warmup_job_status(job_id):
+    check_admin_token()
+    return jsonify(get_warmup_job(job_id).stats())
+
+@app.route('/admin/warmup/<job_id>', methods=['DELETE'])
+def cancel_warmup_job(job_id):
+    check_admin_token()
+    job = get_warmup_job(job_id)
+    job.cancel()
+    return jsonify(job.stats())
+
+def get_content_validators(token_uri, chain_id):
+    """
+    Get what the response of a token URI is revalidated with before fetching its content.
+
+    :return: A tuple with the kind of the token URI, its Cache-Control, and its unquoted ETag
+             or None if it depends on the content.
+    """
+    kind = get_token_uri_kind(token_uri)
+    return kind, get_cache_control(chain_id, kind), get_token_uri_etag(token_uri)
+
+def get_content_response(token_uri, chain_id):
+    """
+    Build the response with the content of a token URI, with its ETag and Cache-Control.
+    IPFS and raw results are revalidated without fetching the content.
+
+    :param token_uri: The resolved token URI.
+    :param chain_id: The chain ID of the location.
+    :return: The Flask Response.
+    """
+    kind, cache_control, etag = get_content_validators(token_uri, chain_id)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag, cache_control)
+
+    if STREAM_PROXY:
+        response = stream_token_uri_content(token_uri)
+        if response is not None:
+            return add_cache_headers(response, etag, cache_control, keep_upstream=kind == 'url')
+
+    token_uri_result, is_json = fetch_token_uri_content(token_uri)
+    if is_json:
+        return add_cache_headers(jsonify(token_uri_result), etag, cache_control)
+    logging.info(f"Fetched {len(token_uri_result)} characters from {token_uri}")
+    return add_cache_headers(
+        make_response(token_uri_result), content_etag(token_uri_result.encode()), cache_control)
+
+@app.route('/<path:path>', methods=['GET'])
+def handle_request(path):
+    location = None
+    chain_id = None
+    timer = StageTimer()
+    try:
+        with timer.stage('parse'):
+            location = get_ul_fields(path)
+
+        with timer.stage('chain'):
+            rpc_urls, chain_id = get_location_chain(location)
+
+        with timer.stage('tokenuri'):
+            token_uri = get_token_uri(rpc_urls, location.AccountKey20, location.GeneralKey, chain_id, key=location.key)
+        if not token_uri:
+            abort(404, description="Token URI not found")
 
-        
+        with timer.stage('content'):
+            response = get_content_response(token_uri, chain_id)
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = timer.server_timing()
+        return response
 
     except Exception as e:
         # Let Flask handle the HTTP exceptions as intended (e.g., 400, 404, etc.)
-        logging.error(f"An error occurred: {e}")
+        if location is not None:
+            logging.error(f"An error occurred for {location.key}: {e}")
+        else:
+            logging.error(f"An error occurred: {e}")
         raise e
+    finally:
+        timer.observe(chain_id)
 
 if __name__ == '__main__':
+    load_configuration()
     app.run(host='0.0.0.0', port=8080, debug=False)
@@ -0,0 +1,699 @@
+"""
+ASGI entry point of the gateway, for production serving with an ASGI server:
+
+    $ uvicorn asgi:application --host 0.0.0.0 --port 8080
+
+Universal location lookups (GET /<path>) run on asyncio, with a shared aiohttp client and
+a concurrency limit per upstream, so slow RPC nodes or gateways do not tie up worker
+threads. The upstream limits and the admission queue of the lookups missing a cache are
+the same as in app.py, and so is the logic shared with the Flask routes: only the I/O
+differs. The tokenURI and CID caches may be backed by Redis or SQLite, so they are accessed
+in worker threads to keep the event loop free. Every other route is served by the Flask app,
+each request in a thread of a pool of FLASK_WORKERS threads.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from urllib.parse import urlparse
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.exceptions import HTTPException, InternalServerError, NotFound, MethodNotAllowed
+from werkzeug.http import parse_etags, quote_etag
+
+import app as gateway
+
+# Maximum number of concurrent requests to each IPFS gateway ("maxConcurrency" in
+# supportedIPFSGateways.json) and to each host serving URL token URIs. RPC URLs are limited
+# to the "rpcPoolSize" of their chain.
+DEFAULT_GATEWAY_MAX_CONCURRENCY = 20
+URL_HOST_MAX_CONCURRENCY = 20
+
+# Maximum number of requests to the Flask routes (/batch, /admin/*, /metrics...) served at once
+FLASK_WORKERS = int(os.environ.get('FLASK_WORKERS', 16))
+
+_upstream_limits = {}
+
+async def run_blocking(function, *args):
+    """
+    Run a blocking call, such as a cache access, in the default executor of the loop
+    (asyncio.to_thread only exists since Python 3.9).
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, partial(function, *args))
+
+def get_upstream_limit(upstream, limit):
+    """
+    Get the semaphore bounding the concurrent requests to an upstream.
+
+    :param upstream: The upstream URL or host.
+    :param limit: The maximum number of concurrent requests, used on first use.
+    :return: The asyncio.Semaphore of the upstream.
+    """
+    # Keyed by the limit too, so that a limit changed by a configuration reload takes effect
+    semaphore = _upstream_limits.get((upstream, limit))
+    if semaphore is None:
+        semaphore = _upstream_limits[(upstream, limit)] = asyncio.Semaphore(limit)
+    return semaphore
+
+class AsyncSingleFlight:
+    """
+    Asyncio counterpart of app.SingleFlight: concurrent calls with the same key await the
+    coroutine of the first one and share its result or exception.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.in_flight = {}
+        self.counters = {"calls": 0, "executions": 0}
+        if name is not None:
+            gateway.register_single_flight(self)
+
+    async def do(self, key, coroutine_function):
+        self.counters["calls"] += 1
+        future = self.in_flight.get(key)
+        gateway.count_single_flight_call(self, future is None)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        self.counters["executions"] += 1
+        future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await coroutine_function()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieve the exception so it is not reported as never retrieved
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+
+    def stats(self):
+        return gateway.single_flight_stats(self.counters["calls"], self.counters["executions"], len(self.in_flight))
+
+# Reported together with the flights of app.py
+token_uri_flight = AsyncSingleFlight('tokenUri')
+content_flight = AsyncSingleFlight('content')
+
+class AsyncAdmissionQueue:
+    """
+    Asyncio counterpart of app.AdmissionQueue, with the same concurrency but a budget of its
+    own: the Flask routes served next to it keep admitting through app.lookup_queue. Waiting
+    lookups hold no thread, so up to LOOKUP_QUEUE_SIZE of them can queue.
+    """
+
+    def __init__(self, max_concurrency=gateway.LOOKUP_MAX_CONCURRENCY, max_queued=gateway.LOOKUP_QUEUE_SIZE,
+                 timeout=gateway.LOOKUP_QUEUE_TIMEOUT, name='asyncio'):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.semaphore = None
+        self.running = 0
+        self.queued = 0
+        self.counters = {"admitted": 0, "queueFull": 0, "timedOut": 0}
+
+    @asynccontextmanager
+    async def slot(self):
+        # Created in the running loop, as with the upstream limits
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.semaphore.locked():
+            if self.queued >= self.max_queued:
+                self.counters["queueFull"] += 1
+                raise gateway.lookup_refused(self.name, 'queue_full')
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self.counters["timedOut"] += 1
+                raise gateway.lookup_refused(self.name, 'timeout')
+            finally:
+                self.queued -= 1
+        else:
+            await self.semaphore.acquire()
+        self.running += 1
+        self.counters["admitted"] += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    def stats(self):
+        return {"running": self.running, "queued": self.queued, **self.counters}
+
+lookup_queue = AsyncAdmissionQueue()
+gateway.register_admission_queue(lookup_queue)
+
+async def resolve_token_uri_async(session, rpc_urls, contract_address, asset_id, chain_id=None):
+    """
+    Asyncio counterpart of app.resolve_token_uri, sharing its endpoint health tracking and limits.
+
+    :return: The token URI, or None if no RPC node answered. Raises TokenNotFound if the call
+             reverted, or a ServiceUnavailable if the nodes that did not fail are over their limits.
+    """
+    clients = gateway.order_rpc_clients(rpc_urls, chain_id)
+    if not clients:
+        logging.error("All RPC URLs are unavailable, circuit breakers are open.")
+        return None
+
+    failed = False
+    throttled = []
+    for attempt, client in enumerate(clients):
+        payload = client.token_uri_request(contract_address, asset_id)
+        if not gateway.claim_rpc_client(client, chain_id, throttled, failed):
+            continue
+        start = time.monotonic()
+        try:
+            async with get_upstream_limit(client.rpc_url, client.pool_size):
+                async with session.post(client.rpc_url, json=payload,
+                                        timeout=aiohttp.ClientTimeout(total=client.timeout)) as response:
+                    response.raise_for_status()
+                    answer = await response.json(content_type=None)
+            token_uri = gateway.decode_token_uri_answer(answer)
+        except Exception as e:
+            token_uri = e
+        finally:
+            client.limiter.release()
+        if gateway.record_token_uri_call(client, chain_id, token_uri, time.monotonic() - start, attempt):
+            return token_uri
+        failed = True
+    return gateway.token_uri_unresolved(throttled)
+
+async def get_token_uri_async(session, rpc_urls, contract_address, asset_id, chain_id=None, key=None):
+    """
+    Asyncio counterpart of app.get_token_uri, reading and filling the same tokenURI cache.
+    """
+    if key is None:
+        key = gateway.token_uri_cache_key(rpc_urls, contract_address, asset_id, chain_id)
+    entry = await run_blocking(gateway.get_cached_token_uri, key, rpc_urls, contract_address, asset_id, chain_id)
+    if entry is not None:
+        return entry["uri"]
+
+    async def fetch_and_cache():
+        try:
+            async with lookup_queue.slot():
+                token_uri = await resolve_token_uri_async(session, rpc_urls, contract_address, asset_id, chain_id)
+        except gateway.TokenNotFound as e:
+            token_uri = e
+        return await run_blocking(gateway.store_resolved_token_uri, key, token_uri, chain_id)
+    return await token_uri_flight.do(key, fetch_and_cache)
+
+async def open_upstream_stream_async(session, url, timeout):
+    """
+    Asyncio counterpart of app.open_upstream_stream, always asking for an uncompressed body.
+
+    :return: The aiohttp response, with its body not read yet; raises if the request fails
+             or is too large.
+    """
+    response = await session.get(url, timeout=timeout, headers={'Accept-Encoding': 'identity'})
+    try:
+        response.raise_for_status()
+        if response.content_length is not None and response.content_length > gateway.MAX_PROXY_BODY_SIZE:
+            raise ValueError(f"Content-Length {response.content_length} exceeds the maximum of {gateway.MAX_PROXY_BODY_SIZE} bytes")
+    except Exception:
+        response.release()
+        raise
+    return response
+
+def release_streamed_response(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result().release()
+
+async def fetch_from_ipfs_gateway_async(session, ipfs_gateway, cid, stream=False):
+    """
+    Asyncio counterpart of app.fetch_from_ipfs_gateway.
+    """
+    ipfs_gateway_url = ipfs_gateway.get("url")
+    full_uri = f'{ipfs_gateway_url}{cid}{ipfs_gateway.get("apiKeySuffix")}'
+    timeout = aiohttp.ClientTimeout(total=float(ipfs_gateway.get("timeout", gateway.DEFAULT_IPFS_GATEWAY_TIMEOUT)))
+    limit = int(ipfs_gateway.get("maxConcurrency", DEFAULT_GATEWAY_MAX_CONCURRENCY))
+    limiter = gateway.get_gateway_limiter(ipfs_gateway)
+    if not limiter.try_acquire():
+        raise gateway.UpstreamThrottled(limiter)
+    start = time.monotonic()
+    try:
+        async with get_upstream_limit(ipfs_gateway_url, limit):
+            if stream:
+                content = await open_upstream_stream_async(session, full_uri, timeout)
+                status = content.status
+            else:
+                async with session.get(full_uri, timeout=timeout) as response:
+                    response.raise_for_status()
+                    content = await response.json(content_type=None)
+                    status = response.status
+    except asyncio.CancelledError:
+        raise
+    except Exception as err:
+        gateway.record_gateway_fetch(ipfs_gateway_url, time.monotonic() - start, error=err)
+        raise
+    finally:
+        limiter.release()
+    gateway.record_gateway_fetch(ipfs_gateway_url, time.monotonic() - start, status=status)
+    return content
+
+async def race_ipfs_gateways_async(session, cid, stream=False):
+    """
+    Asyncio counterpart of app.race_ipfs_gateways: gateways are raced the same way, and the
+    losing requests are cancelled as soon as one gateway answers.
+    """
+    ipfs_gateways = gateway.order_ipfs_gateways(gateway.get_ipfs_gateways())
+    pending = set()
+    throttled = []
+    next_gateway = 0
+    try:
+        while next_gateway < len(ipfs_gateways) or pending:
+            hedge_delay = None
+            if next_gateway < len(ipfs_gateways):
+                ipfs_gateway = ipfs_gateways[next_gateway]
+                pending.add(asyncio.ensure_future(fetch_from_ipfs_gateway_async(session, ipfs_gateway, cid, stream)))
+                next_gateway += 1
+                if next_gateway < len(ipfs_gateways):
+                    hedge_delay = gateway.get_hedge_delay(ipfs_gateway)
+
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if winners:
+                if stream:
+                    for other in winners[1:]:
+                        release_streamed_response(other)
+                return winners[0].result()
+            throttled.extend(
+                task.exception().limiter for task in done if isinstance(task.exception(), gateway.UpstreamThrottled))
+    finally:
+        for task in pending:
+            task.cancel()
+            if stream:
+                task.add_done_callback(release_streamed_response)
+
+    if throttled:
+        logging.error("Failed to fetch data from IPFS, gateways are over their limits.")
+        raise gateway.throttled_error(throttled)
+    logging.error("Failed to fetch data from all IPFS gateways.")
+    return None
+
+async def fetch_ipfs_content_async(session, token_uri):
+    """
+    Asyncio counterpart of app.fetch_ipfs_content.
+    """
+    return await race_ipfs_gateways_async(session, gateway.get_cid(token_uri))
+
+async def get_ipfs_content_async(session, token_uri):
+    """
+    Asyncio counterpart of app.get_ipfs_content, reading and filling the same CID cache.
+    """
+    cid = gateway.get_cid(token_uri)
+    content = await run_blocking(gateway.ipfs_cache.get, cid)
+    if content is not None:
+        return content
+
+    async def fetch_and_cache():
+        async with lookup_queue.slot():
+            content = await fetch_ipfs_content_async(session, token_uri)
+        if content is not None:
+            await run_blocking(gateway.ipfs_cache.put, cid, content)
+        return content
+    return await content_flight.do(token_uri, fetch_and_cache)
+
+async def fetch_url_content_async(session, url):
+    """
+    Asyncio counterpart of app.fetch_url_content.
+    """
+    start = time.monotonic()
+    try:
+        async with get_upstream_limit(urlparse(url).netloc, URL_HOST_MAX_CONCURRENCY):
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=gateway.URL_FETCH_TIMEOUT)) as response:
+                gateway.UPSTREAM_RESPONSES.labels('http', str(response.status)).inc()
+                response.raise_for_status()
+                body = await read_upstream_body_async(response)
+                return body.decode(response.get_encoding(), errors='replace')
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        if not isinstance(e, (aiohttp.ClientResponseError, ValueError)):
+            gateway.UPSTREAM_RESPONSES.labels('http', 'error').inc()
+        logging.error(f"Error fetching the URL content: {e}")
+        return None
+    finally:
+        gateway.HTTP_FETCH_SECONDS.observe(time.monotonic() - start)
+
+async def fetch_token_uri_content_async(session, token_uri):
+    """
+    Asyncio counterpart of app.fetch_token_uri_content.
+    """
+    if gateway.is_valid_ipfs(token_uri):
+        token_uri_result = await get_ipfs_content_async(session, token_uri)
+        if not token_uri_result:
+            gateway.abort_content_unavailable(token_uri)
+        return token_uri_result, True
+
+    if gateway.is_valid_url(token_uri):
+        async def fetch():
+            async with lookup_queue.slot():
+                return await fetch_url_content_async(session, token_uri)
+        token_uri_result = await content_flight.do(token_uri, fetch)
+        if not token_uri_result:
+            gateway.abort_content_unavailable(token_uri)
+        return token_uri_result, False
+
+    return {"token_uri": token_uri}, True
+
+async def read_upstream_body_async(response):
+    """
+    Asyncio counterpart of app.read_upstream_body.
+
+    :param response: The aiohttp response.
+    """
+    body = []
+    size = 0
+    async for chunk in response.content.iter_chunked(gateway.PROXY_CHUNK_SIZE):
+        size += len(chunk)
+        if size > gateway.MAX_PROXY_BODY_SIZE:
+            raise ValueError(f"Body exceeds the maximum of {gateway.MAX_PROXY_BODY_SIZE} bytes")
+        body.append(chunk)
+    return b''.join(body)
+
+async def open_body(response, on_complete=None, validate_json=False):
+    """
+    Asyncio counterpart of app.stream_upstream_response: only unencoded bodies with a
+    Content-Length are streamed, the others are read up to app.MAX_PROXY_BODY_SIZE first. aiohttp
+    decodes encoded bodies, so they no longer match their upstream Content-Length.
+
+    :param response: The aiohttp response.
+    :param on_complete: Optional blocking callable receiving the whole body once it was
+                        forwarded, run in a worker thread.
+    :param validate_json: Whether the body must be JSON, checked before the status is sent.
+    :return: The body as bytes, or an async iterator of its chunks; raises ValueError if the
+             body is too large or not JSON, or the error reading it from upstream.
+    """
+    buffered = response.content_length is None or gateway.is_encoded(response.headers)
+    try:
+        if buffered:
+            body = await read_upstream_body_async(response)
+            if validate_json:
+                json.loads(body)
+        else:
+            chunks = response.content.iter_chunked(gateway.PROXY_CHUNK_SIZE)
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = b''
+            if validate_json and not gateway.sniff_json(first):
+                raise ValueError(f"Content of {response.url} is not JSON")
+    except BaseException:
+        response.release()
+        raise
+
+    if buffered:
+        response.release()
+        if on_complete:
+            await run_blocking(on_complete, body)
+        return body
+    return stream_body(response, first, chunks, on_complete)
+
+async def stream_body(response, first, chunks, on_complete=None):
+    """
+    Forward the body of an upstream response in chunks, cut at app.MAX_PROXY_BODY_SIZE if the
+    upstream sends more than its Content-Length.
+
+    :param response: The aiohttp response.
+    :param first: The first chunk, already read.
+    :param chunks: The async iterator of the following chunks.
+    :param on_complete: Optional blocking callable receiving the whole body once it was
+                        forwarded, run in a worker thread.
+    """
+    size = len(first)
+    body = [first] if on_complete else None
+    try:
+        yield first
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > gateway.MAX_PROXY_BODY_SIZE:
+                logging.error(f"Body of {response.url} exceeds the maximum of {gateway.MAX_PROXY_BODY_SIZE} bytes, truncated")
+                return
+            if body is not None:
+                body.append(chunk)
+            yield chunk
+        if on_complete:
+            await run_blocking(on_complete, b''.join(body))
+    finally:
+        response.release()
+
+def passthrough_headers(response, body):
+    # The length of a buffered body is set when it is sent
+    return [
+        (name.lower().encode(), response.headers[name].encode())
+        for name in gateway.PASSTHROUGH_HEADERS
+        if name in response.headers and not (name == 'Content-Length' and isinstance(body, bytes))
+    ]
+
+async def stream_token_uri_content_async(session, token_uri):
+    """
+    Asyncio counterpart of app.stream_token_uri_content.
+
+    :return: A tuple with the status code, headers and body, or None if the token URI is
+             neither IPFS nor a URL.
+    """
+    if gateway.is_valid_ipfs(token_uri):
+        cid = gateway.get_cid(token_uri)
+        content = await run_blocking(gateway.ipfs_cache.get, cid)
+        if content is not None:
+            return json_response(content)
+        async with lookup_queue.slot():
+            response = await race_ipfs_gateways_async(session, cid, stream=True)
+        if response is None:
+            gateway.abort_content_unavailable(token_uri)
+        try:
+            body = await open_body(
+                response, on_complete=partial(gateway.cache_streamed_content, token_uri), validate_json=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"Error reading the IPFS content: {e}")
+            gateway.abort_content_unavailable(token_uri)
+        return 200, passthrough_headers(response, body), body
+
+    if gateway.is_valid_url(token_uri):
+        start = time.monotonic()
+        try:
+            async with lookup_queue.slot(), get_upstream_limit(urlparse(token_uri).netloc, URL_HOST_MAX_CONCURRENCY):
+                response = await open_upstream_stream_async(
+                    session, token_uri, aiohttp.ClientTimeout(total=gateway.URL_FETCH_TIMEOUT))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            gateway.UPSTREAM_RESPONSES.labels('http', gateway.get_upstream_status(e)).inc()
+            logging.error(f"Error fetching the URL content: {e}")
+            gateway.abort_content_unavailable(token_uri)
+        finally:
+            gateway.HTTP_FETCH_SECONDS.observe(time.monotonic() - start)
+        gateway.UPSTREAM_RESPONSES.labels('http', str(response.status)).inc()
+        try:
+            body = await open_body(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"Error reading the URL content: {e}")
+            gateway.abort_content_unavailable(token_uri)
+        return 200, passthrough_headers(response, body), body
+
+    return None
+
+def json_response(content, status=200):
+    # Same output as Flask's jsonify
+    body = (json.dumps(content, sort_keys=True, separators=(",", ":")) + "\n").encode()
+    return status, [(b"content-type", b"application/json")], body
+
+def not_modified_response(etag, cache_control):
+    return 304, [(b"etag", quote_etag(etag, weak=True).encode()), (b"cache-control", cache_control.encode())], b""
+
+def add_cache_headers(response, etag, cache_control, if_none_match, keep_upstream=False):
+    """
+    Asyncio counterpart of app.add_cache_headers.
+
+    :param response: A tuple with the status code, headers and body.
+    :param if_none_match: The parsed If-None-Match of the request.
+    :return: The response to send.
+    """
+    status, headers, body = response
+    upstream_cache_control = dict(headers).get(b"cache-control")
+    if keep_upstream and upstream_cache_control is not None:
+        cache_control = upstream_cache_control.decode('latin-1')
+    if etag is not None and if_none_match.contains_weak(etag):
+        return not_modified_response(etag, cache_control)
+    replaced = (b"cache-control", b"etag") if etag is not None else (b"cache-control",)
+    headers = [(name, value) for name, value in headers if name not in replaced]
+    headers.append((b"cache-control", cache_control.encode()))
+    if etag is not None:
+        headers.append((b"etag", quote_etag(etag, weak=True).encode()))
+    return status, headers, body
+
+async def get_content_response_async(session, token_uri, chain_id, if_none_match):
+    """
+    Asyncio counterpart of app.get_content_response.
+
+    :param if_none_match: The parsed If-None-Match of the request.
+    :return: A tuple with the status code, headers and body, as bytes or an async iterator of bytes.
+    """
+    kind, cache_control, etag = gateway.get_content_validators(token_uri, chain_id)
+    if etag is not None and if_none_match.contains_weak(etag):
+        return not_modified_response(etag, cache_control)
+
+    if gateway.STREAM_PROXY:
+        response = await stream_token_uri_content_async(session, token_uri)
+        if response is not None:
+            return add_cache_headers(response, etag, cache_control, if_none_match, keep_upstream=kind == 'url')
+
+    token_uri_result, is_json = await fetch_token_uri_content_async(session, token_uri)
+    if is_json:
+        return add_cache_headers(json_response(token_uri_result), etag, cache_control, if_none_match)
+    logging.info(f"Fetched {len(token_uri_result)} characters from {token_uri}")
+    body = token_uri_result.encode()
+    return add_cache_headers(
+        (200, [(b"content-type", b"text/html; charset=utf-8")], body),
+        gateway.content_etag(body), cache_control, if_none_match)
+
+async def handle_request_async(session, path, if_none_match=None):
+    """
+    Asyncio counterpart of app.handle_request.
+
+    :param if_none_match: The If-None-Match header of the request, if any.
+    :return: A tuple with the status code, headers and body, as bytes or an async iterator of bytes.
+    """
+    chain_id = None
+    timer = gateway.StageTimer()
+    try:
+        with timer.stage('parse'):
+            location = gateway.get_ul_fields(path)
+
+        with timer.stage('chain'):
+            rpc_urls, chain_id = gateway.get_location_chain(location)
+
+        with timer.stage('tokenuri'):
+            token_uri = await get_token_uri_async(session, rpc_urls, location.AccountKey20, location.GeneralKey, chain_id, key=location.key)
+        if not token_uri:
+            gateway.abort(404, description="Token URI not found")
+
+        with timer.stage('content'):
+            status, headers, body = await get_content_response_async(
+                session, token_uri, chain_id, parse_etags(if_none_match))
+        if gateway.SERVER_TIMING:
+            headers = headers + [(b"server-timing", timer.server_timing().encode())]
+        return status, headers, body
+    finally:
+        timer.observe(chain_id)
+
+def error_response(e):
+    """
+    The JSON error body of app.handle_exception.
+
+    :return: A tuple with the status code, headers and body.
+    """
+    if not isinstance(e, HTTPException):
+        e = InternalServerError()
+    body = json.dumps({"code": e.code, "name": e.name, "description": e.description})
+    headers = [(b"content-type", b"application/json")]
+    if getattr(e, 'retry_after', None) is not None:
+        headers.append((b"retry-after", str(e.retry_after).encode()))
+    return e.code, headers, body.encode()
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """
+    Runs a request of the WSGI app in a thread of the given executor. asgiref runs them with
+    thread_sensitive=True by default, i.e. one at a time on a single shared thread, so a long
+    /batch would hold up /metrics and every other Flask route.
+    """
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        run_wsgi_app = WsgiToAsgiInstance.run_wsgi_app.__wrapped__
+        await sync_to_async(run_wsgi_app, thread_sensitive=False, executor=self.executor)(self, body)
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """
+    WsgiToAsgi serving the requests of the WSGI app concurrently, on at most max_workers
+    threads.
+    """
+
+    def __init__(self, wsgi_application, max_workers=FLASK_WORKERS):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='flask')
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiToAsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+class GatewayApplication:
+    """
+    ASGI application serving universal location lookups on asyncio and delegating every
+    other route to the Flask app.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.fallback = ThreadedWsgiToAsgi(flask_app)
+        self.session = None
+
+    def is_location_request(self, scope):
+        adapter = self.flask_app.url_map.bind('')
+        try:
+            endpoint, _ = adapter.match(scope["path"], method=scope["method"])
+        except (NotFound, MethodNotAllowed):
+            return False
+        return endpoint == 'handle_request'
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                gateway.load_configuration()
+                await self.get_session()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.session is not None:
+                    await self.session.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http" or not self.is_location_request(scope):
+            await self.fallback(scope, receive, send)
+            return
+
+        path = scope["path"].lstrip('/')
+        request_headers = dict(scope["headers"])
+        if_none_match = request_headers.get(b"if-none-match", b"").decode('latin-1') or None
+        try:
+            status, headers, body = await handle_request_async(await self.get_session(), path, if_none_match)
+        except Exception as e:
+            logging.error(f"An error occurred: {e}")
+            status, headers, body = error_response(e)
+
+        # flask_cors allows every origin on the Flask routes
+        headers = headers + [(b"access-control-allow-origin", b"*")]
+        if isinstance(body, bytes):
+            if status != 304:
+                headers.append((b"content-length", str(len(body)).encode()))
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        try:
+            async for chunk in body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await body.aclose()
+        await send({"type": "http.response.body", "body": b""})
+
+application = GatewayApplication(gateway.app)
@@ -0,0 +1,457 @@
+"""
+Load test of the gateway against local stand-ins of its upstreams, runnable offline:
+
+    $ python benchmark.py
+    $ python benchmark.py --target asgi
+    $ python benchmark.py --save-baseline bench_baseline.json
+    $ python benchmark.py --compare bench_baseline.json
+
+Each scenario starts fake JSON-RPC nodes answering eth_call for tokenURI and fake IPFS
+gateways with their own latency, error rate and hang rate, points the gateway at them and
+sends concurrent lookups through the Flask app (wsgi target) or the asyncio entry point
+served in production (asgi target, asgi:application). The fake upstreams and the gateway
+run in separate processes, so that they do not compete for the GIL, and every scenario
+starts from a fresh gateway process. It reports the requests per second, the p50/p99 latency
+and the peak resident memory of the gateway process for every scenario and target.
+
+The measures depend on the machine, so no baseline is shipped: the comparison is opt-in,
+against a baseline saved with --save-baseline on the same machine. With --compare, the run
+fails when a scenario is worse than the baseline by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_abi import encode_abi
+
+import app as gateway
+
+CONTRACT_ADDRESS = '0xfffffffffffffffffffffffe000000000000007b'
+LOCATION_PREFIX = f'GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20({CONTRACT_ADDRESS})'
+CID = 'QmBenchmarkCollection'
+# Hung requests are held longer than the upstream timeouts of the benchmark configuration
+HANG_SECONDS = 5
+UPSTREAM_TIMEOUT = 1
+
+DEFAULT_REQUESTS = 500
+DEFAULT_CONCURRENCY = 16
+# Allowed relative regression of the throughput, p99 latency and peak memory
+DEFAULT_TOLERANCE = 0.25
+TARGETS = ('wsgi', 'asgi')
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    """
+    A local HTTP server answering with a configurable latency, and failing or hanging a
+    configurable share of the requests.
+
+    :param answer: Callable receiving the handler and returning (status, JSON-serializable body).
+    :param latency: Seconds to wait before answering.
+    :param error_rate: Share of the requests answered with a 500.
+    :param hang_rate: Share of the requests held for HANG_SECONDS before being answered.
+    :param seed: Seed of the random failures, so that runs are reproducible.
+    """
+    daemon_threads = True
+    # The default backlog of 5 drops the connections of concurrent clients
+    request_queue_size = 128
+
+    def __init__(self, answer, latency=0.0, error_rate=0.0, hang_rate=0.0, seed=0):
+        super().__init__(('127.0.0.1', 0), FakeUpstreamHandler)
+        self.answer = answer
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def draw(self):
+        with self.random_lock:
+            self.requests += 1
+            return self.random.random()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        draw = server.draw()
+        if server.latency:
+            time.sleep(server.latency)
+        if draw < server.hang_rate:
+            time.sleep(HANG_SECONDS)
+        if draw >= 1 - server.error_rate:
+            status, content = 500, {"error": "fake upstream failure"}
+        else:
+            status, content = server.answer(self, body)
+        data = json.dumps(content).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The gateway gave up on a hung request
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def answer_eth_call(handler, body):
+    """
+    Answer JSON-RPC eth_call requests for tokenURI(uint256), single or batched, with
+    ipfs://CID/<tokenId>.
+    """
+    payload = json.loads(body)
+
+    def answer(call):
+        if call.get("method") != "eth_call":
+            return {"jsonrpc": "2.0", "id": call.get("id"), "error": {"code": -32601, "message": "Method not found"}}
+        token_id = int(call["params"][0]["data"][10:74], 16)
+        result = '0x' + encode_abi(['string'], [f'ipfs://{CID}/{token_id}']).hex()
+        return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+    if isinstance(payload, list):
+        return 200, [answer(call) for call in payload]
+    return 200, answer(payload)
+
+
+def answer_ipfs_content(handler, body):
+    token_id = handler.path.rsplit('/', 1)[-1]
+    return 200, {"name": f"Token {token_id}", "image": f"ipfs://{CID}/{token_id}.png"}
+
+ANSWERS = {"rpc": answer_eth_call, "ipfs": answer_ipfs_content}
+
+def serve_upstreams(specs, connection):
+    """
+    Run fake upstreams until told to stop. Runs in its own process.
+
+    :param specs: A list of (kind of answer, FakeUpstream keyword arguments) pairs.
+    :param connection: The multiprocessing connection on which the URLs of the upstreams are
+                       sent, and the stop message received.
+    """
+    servers = [FakeUpstream(ANSWERS[kind], seed=index, **settings).start()
+               for index, (kind, settings) in enumerate(specs)]
+    connection.send([server.url for server in servers])
+    connection.recv()
+    for server in servers:
+        server.stop()
+
+
+class Scenario:
+    """
+    A benchmark scenario: the fake upstreams to start and the token IDs to look up.
+
+    :param name: The scenario name.
+    :param description: What the scenario measures.
+    :param rpc_nodes: Keyword arguments of the FakeUpstream of each RPC node, in configuration order.
+    :param ipfs_gateways: Keyword arguments of the FakeUpstream of each IPFS gateway.
+    :param hot: Whether every request asks for the same token instead of a new one.
+    """
+
+    def __init__(self, name, description, rpc_nodes, ipfs_gateways, hot=False):
+        self.name = name
+        self.description = description
+        self.rpc_nodes = rpc_nodes
+        self.ipfs_gateways = ipfs_gateways
+        self.hot = hot
+
+    def token_ids(self, requests):
+        return [1] * requests if self.hot else list(range(1, requests + 1))
+
+    @property
+    def warm_up_token_id(self):
+        # Opens the connections and fills the contract cache without warming a measured token,
+        # except the hot one
+        return 1 if self.hot else 0
+
+
+SCENARIOS = [
+    Scenario('hot-key', 'the same token on every request, served from the caches',
+             rpc_nodes=[{"latency": 0.005}], ipfs_gateways=[{"latency": 0.01}], hot=True),
+    Scenario('cold-key', 'a new token on every request, resolved on the chain and fetched from IPFS',
+             rpc_nodes=[{"latency": 0.005}], ipfs_gateways=[{"latency": 0.01}]),
+    Scenario('failing-first-rpc', 'cold keys with the first RPC node failing or hanging',
+             rpc_nodes=[{"latency": 0.005, "error_rate": 0.8, "hang_rate": 0.2}, {"latency": 0.005}],
+             ipfs_gateways=[{"latency": 0.01}]),
+    Scenario('slow-gateway', 'cold keys with the first IPFS gateway slow and sometimes failing',
+             rpc_nodes=[{"latency": 0.005}],
+             ipfs_gateways=[{"latency": 0.3, "error_rate": 0.1}, {"latency": 0.02}]),
+]
+
+
+def configure_gateway(rpc_urls, ipfs_urls):
+    """
+    Point the gateway at the fake upstreams, with fresh in-memory caches.
+    """
+    consensus = [{
+        "Name": "Benchmark",
+        "GlobalConsensus": "3",
+        "Parachain": "3336",
+        "PalletInstance": "51",
+        "ChainId": "2718",
+        "rpc": rpc_urls,
+        "rpcTimeout": UPSTREAM_TIMEOUT,
+    }]
+    ipfs_gateways = [
+        {"url": f'{url}/ipfs/', "apiKeySuffix": "", "timeout": UPSTREAM_TIMEOUT, "hedgeDelay": 0.05}
+        for url in ipfs_urls
+    ]
+    gateway.consensus_registry = gateway.ConfigRegistry([], lambda: consensus, gateway.build_consensus_index)
+    gateway.ipfs_gateway_registry = gateway.ConfigRegistry([], lambda: ipfs_gateways, gateway.build_ipfs_gateway_list)
+    gateway.ipfs_cache = gateway.CIDCache()
+    gateway.token_uri_cache = gateway.TokenURICache(gateway.MemoryCacheBackend())
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def send_wsgi_lookups(paths, concurrency):
+    """
+    Send lookups through the Flask app from a pool of threads.
+
+    :return: The (seconds, status) of each lookup and the elapsed seconds of the whole load.
+    """
+    client = gateway.app.test_client()
+
+    def lookup(path):
+        start = time.perf_counter()
+        response = client.get(path)
+        response.close()
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lookup, paths))
+    return results, time.perf_counter() - start
+
+
+async def send_asgi_lookups(paths, concurrency):
+    """
+    Send lookups through the ASGI application, at most "concurrency" at once on one event loop.
+
+    :return: The (seconds, status) of each lookup and the elapsed seconds of the whole load.
+    """
+    # Imported here so the wsgi target does not pay for it
+    from asgi import application
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def lookup(path):
+        status = None
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+            "headers": [(b"host", b"localhost")], "server": ("localhost", 80), "client": ("127.0.0.1", 1234),
+        }
+        async with semaphore:
+            start = time.perf_counter()
+            await application(scope, receive, send)
+            return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(lookup(path) for path in paths))
+    return results, time.perf_counter() - start
+
+
+def load_gateway(rpc_urls, ipfs_urls, token_ids, warm_up_token_id, concurrency, verbose=False, target='wsgi'):
+    """
+    Send the lookups of a scenario through the gateway, after an untimed warm-up lookup.
+    Runs in its own process.
+
+    :param target: 'wsgi' for the Flask app, 'asgi' for the asyncio entry point.
+    :return: A dict with the "requests", "errors", "rps", "p50Ms", "p99Ms" and "peakRssKb".
+    """
+    if not verbose:
+        # Injected failures would flood the output
+        logging.disable(logging.CRITICAL)
+    configure_gateway(rpc_urls, ipfs_urls)
+    paths = [f'/{LOCATION_PREFIX}/GeneralKey({token_id})' for token_id in [warm_up_token_id, *token_ids]]
+
+    if target == 'asgi':
+        from asgi import application
+
+        async def send_lookups():
+            try:
+                await send_asgi_lookups(paths[:1], 1)
+                return await send_asgi_lookups(paths[1:], concurrency)
+            finally:
+                if application.session is not None:
+                    await application.session.close()
+        results, elapsed = asyncio.run(send_lookups())
+    else:
+        send_wsgi_lookups(paths[:1], 1)
+        results, elapsed = send_wsgi_lookups(paths[1:], concurrency)
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, status in results if status != 200),
+        "rps": round(len(results) / elapsed, 1),
+        "p50Ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99Ms": round(percentile(latencies, 0.99) * 1000, 2),
+        # Kilobytes on Linux
+        "peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_scenario(scenario, requests=DEFAULT_REQUESTS, concurrency=DEFAULT_CONCURRENCY, verbose=False, target='wsgi'):
+    """
+    Run a scenario in fresh processes and measure it on a target.
+
+    :return: The measures of load_gateway.
+    """
+    context = multiprocessing.get_context('spawn')
+    specs = ([("rpc", settings) for settings in scenario.rpc_nodes]
+             + [("ipfs", settings) for settings in scenario.ipfs_gateways])
+    connection, upstream_connection = context.Pipe()
+    upstreams = context.Process(target=serve_upstreams, args=(specs, upstream_connection), daemon=True)
+    upstreams.start()
+    try:
+        urls = connection.recv()
+        rpc_urls, ipfs_urls = urls[:len(scenario.rpc_nodes)], urls[len(scenario.rpc_nodes):]
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            return executor.submit(
+                load_gateway, rpc_urls, ipfs_urls, scenario.token_ids(requests), scenario.warm_up_token_id,
+                concurrency, verbose, target).result()
+    finally:
+        connection.send('stop')
+        upstreams.join(timeout=HANG_SECONDS + 1)
+        if upstreams.is_alive():
+            upstreams.terminate()
+
+
+def get_machine():
+    """
+    Describe the machine a baseline is recorded on, since its measures only hold there.
+    """
+    return f"{platform.node()} {platform.machine()} {multiprocessing.cpu_count()} CPUs Python {platform.python_version()}"
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the results to a baseline recorded on the same machine.
+
+    :param results: The results by "<target>/<scenario>".
+    :param baseline: The results of the baseline, in the same format.
+    :param tolerance: The allowed relative regression of the throughput, p99 latency and memory.
+
+    :return: A list of the regressions, as human-readable strings.
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if result["rps"] < reference["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rps']} requests/s, baseline {reference['rps']}")
+        if result["p99Ms"] > reference["p99Ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99Ms']} ms, baseline {reference['p99Ms']}")
+        if result["peakRssKb"] > reference["peakRssKb"] * (1 + tolerance):
+            regressions.append(f"{name}: {result['peakRssKb']} KiB resident, baseline {reference['peakRssKb']}")
+        if result["errors"] > reference["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors, baseline {reference['errors']}")
+    return regressions
+
+
+def format_report(results):
+    lines = [f"{'target/scenario':<26}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'RSS KiB':>10}"]
+    for name, result in results.items():
+        lines.append(
+            f"{name:<26}{result['requests']:>10}{result['errors']:>8}{result['rps']:>10}"
+            f"{result['p50Ms']:>10}{result['p99Ms']:>10}{result['peakRssKb']:>10}"
+        )
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the gateway against local fake upstreams.")
+    parser.add_argument('--scenario', action='append', choices=[scenario.name for scenario in SCENARIOS],
+                        help="Scenario to run, can be repeated (default: all).")
+    parser.add_argument('--target', action='append', choices=TARGETS,
+                        help="Entry point to load, wsgi for the Flask app or asgi for asgi:application, "
+                             "can be repeated (default: both).")
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help="Requests per scenario.")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="Concurrent clients.")
+    parser.add_argument('--verbose', action='store_true', help="Show the errors logged by the gateway.")
+    parser.add_argument('--save-baseline', metavar='PATH', help="Save the results as a JSON baseline of this machine.")
+    parser.add_argument('--compare', metavar='PATH',
+                        help="Fail if the results regress from this baseline, saved on the same machine.")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative regression of the throughput, p99 latency and memory "
+                             f"(default: {DEFAULT_TOLERANCE}).")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for target in args.target or TARGETS:
+        for scenario in SCENARIOS:
+            if args.scenario and scenario.name not in args.scenario:
+                continue
+            results[f"{target}/{scenario.name}"] = run_scenario(
+                scenario, args.requests, args.concurrency, args.verbose, target)
+    print(format_report(results))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({"machine": get_machine(), "results": results}, baseline_file, indent=2)
+            baseline_file.write('\n')
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("machine") != get_machine():
+            print(f"Warning: the baseline was recorded on {baseline.get('machine') or 'another machine'}, "
+                  f"its measures may not hold on {get_machine()}")
+        regressions = compare_to_baseline(results, baseline.get("results", {}), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
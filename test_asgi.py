@@ -0,0 +1,324 @@
+import asyncio
+import gzip
+import json
+import threading
+import unittest
+from unittest.mock import patch, AsyncMock
+
+from aiohttp import web
+from eth_abi import encode_abi
+from prometheus_client import REGISTRY
+
+import app as gateway
+from asgi import *
+
+ADMIN_HEADERS = [(b"authorization", b"Bearer secret")]
+
+
+async def call_asgi(path, method='GET', headers=(), body=b""):
+    """
+    Send a single HTTP request to the ASGI application and collect the response.
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost"), *headers],
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 1234),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    start = next(message for message in messages if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+    return start["status"], dict(start["headers"]), body
+
+
+class TestAsgi(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        ipfs_cache_patcher = patch('app.ipfs_cache', gateway.CIDCache())
+        ipfs_cache_patcher.start()
+        self.addCleanup(ipfs_cache_patcher.stop)
+        token_uri_cache_patcher = patch('app.token_uri_cache', gateway.TokenURICache(gateway.MemoryCacheBackend()))
+        token_uri_cache_patcher.start()
+        self.addCleanup(token_uri_cache_patcher.stop)
+
+    async def asyncTearDown(self):
+        if application.session is not None:
+            await application.session.close()
+
+    @patch('app.get_chain_info')
+    @patch('asgi.get_token_uri_async', new_callable=AsyncMock)
+    @patch('asgi.get_ipfs_content_async', new_callable=AsyncMock)
+    async def test_handle_request_success(self, mock_get_ipfs_content, mock_get_token_uri, mock_get_chain_info):
+        mock_get_chain_info.return_value = (['http://example.com'], '2718')
+        mock_get_token_uri.return_value = 'ipfs://tokenUri'
+        mock_get_ipfs_content.return_value = {'data': 'some data'}
+
+        status, headers, body = await call_asgi('/GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(json.loads(body), {'data': 'some data'})
+        mock_get_token_uri.assert_called_once_with(
+            application.session, ['http://example.com'], '0xfffffffffffffffffffffffe000000000000007b', '789', '2718',
+            key='GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)')
+
+    @patch('app.get_chain_info')
+    @patch('asgi.get_token_uri_async', new_callable=AsyncMock)
+    @patch('asgi.get_ipfs_content_async', new_callable=AsyncMock)
+    async def test_handle_request_not_modified(self, mock_get_ipfs_content, mock_get_token_uri, mock_get_chain_info):
+        mock_get_chain_info.return_value = (['http://example.com'], '2718')
+        mock_get_token_uri.return_value = 'ipfs://someCID'
+
+        status, headers, body = await call_asgi(
+            '/GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)',
+            headers=[(b"if-none-match", b'"someCID"')])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+        self.assertEqual(headers[b"etag"], b'W/"someCID"')
+        self.assertEqual(headers[b"cache-control"], gateway.DEFAULT_CACHE_CONTROL['ipfs'].encode())
+        mock_get_ipfs_content.assert_not_called()
+
+    @patch('app.get_chain_info')
+    @patch('asgi.resolve_token_uri_async', new_callable=AsyncMock)
+    async def test_handle_request_sheds_cold_lookups(self, mock_resolve_token_uri, mock_get_chain_info):
+        mock_get_chain_info.return_value = (['http://example.com'], '2718')
+        prefix = '/GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)'
+        gateway.token_uri_cache.put(f'{prefix.lstrip("/")}/GeneralKey(1)', 'ipfs://someCID', 60, 60)
+        gateway.ipfs_cache.put('someCID', {'data': 'some data'})
+
+        with patch('asgi.lookup_queue', AsyncAdmissionQueue(max_concurrency=0, max_queued=0)):
+            status, headers, body = await call_asgi(f'{prefix}/GeneralKey(2)')
+            self.assertEqual(status, 503)
+            self.assertEqual(headers[b"retry-after"], str(gateway.LOOKUP_RETRY_AFTER).encode())
+            mock_resolve_token_uri.assert_not_called()
+
+            # Cache hits never wait behind cold lookups
+            status, headers, body = await call_asgi(f'{prefix}/GeneralKey(1)')
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), {'data': 'some data'})
+
+    async def test_admission_queue_deadline(self):
+        queue = AsyncAdmissionQueue(max_concurrency=1, max_queued=1, timeout=0.05)
+        async with queue.slot():
+            with self.assertRaises(gateway.ServiceUnavailable):
+                async with queue.slot():
+                    pass
+        async with queue.slot():
+            pass
+        self.assertEqual(queue.counters, {"admitted": 2, "queueFull": 0, "timedOut": 1})
+
+    @patch('app.ADMIN_TOKEN', 'secret')
+    @patch('app.get_chain_info')
+    async def test_admission_reported(self, mock_get_chain_info):
+        mock_get_chain_info.return_value = (['http://example.com'], '2718')
+
+        def shed():
+            return REGISTRY.get_sample_value('gateway_lookups_shed_total',
+                                             {'queue': 'asyncio', 'reason': 'queue_full'}) or 0
+
+        async with lookup_queue.slot():
+            _, _, body = await call_asgi('/admin/status', headers=ADMIN_HEADERS)
+            admission = json.loads(body)["admission"]
+            self.assertEqual(admission["asyncio"]["running"], 1)
+            self.assertEqual(admission["flask"]["running"], 0)
+            self.assertEqual(REGISTRY.get_sample_value('gateway_admission_queue_lookups',
+                                                       {'queue': 'asyncio', 'state': 'running'}), 1)
+
+        before = shed()
+        with patch('asgi.lookup_queue', AsyncAdmissionQueue(max_concurrency=0, max_queued=0)):
+            status, _, _ = await call_asgi('/GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)')
+        self.assertEqual(status, 503)
+        self.assertEqual(shed(), before + 1)
+
+    @patch('app.resolve_batch_token_uris')
+    async def test_slow_batch_does_not_hold_up_metrics(self, mock_resolve_batch_token_uris):
+        release = threading.Event()
+        mock_resolve_batch_token_uris.side_effect = lambda locations: release.wait(5) and ['plain'] * len(locations)
+        body = json.dumps({"locations": ['GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(1)']}).encode()
+
+        batch = asyncio.ensure_future(call_asgi(
+            '/batch', 'POST', [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())], body))
+        try:
+            status, _, _ = await asyncio.wait_for(call_asgi('/metrics'), 2)
+            self.assertEqual(status, 200)
+            self.assertFalse(batch.done())
+        finally:
+            release.set()
+        status, _, body = await batch
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["results"][0]["tokenUri"], 'plain')
+
+    async def test_handle_request_invalid_path(self):
+        status, headers, body = await call_asgi('/GlobalConsensus(123)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)')
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body), {
+            "code": 400,
+            "name": "Bad Request",
+            "description": "URL parameter 'Parachain' is missing or not in the expected order.",
+        })
+
+    async def test_other_routes_served_by_flask(self):
+        status, _, body = await call_asgi('/robots.txt')
+        self.assertEqual(status, 200)
+        self.assertIn(b"User-agent", body)
+
+    @patch('app.STREAM_PROXY', True)
+    @patch('app.get_chain_info')
+    @patch('asgi.get_token_uri_async', new_callable=AsyncMock)
+    async def test_handle_request_streams_url_content(self, mock_get_token_uri, mock_get_chain_info):
+        async def metadata(request):
+            self.assertEqual(request.headers['Accept-Encoding'], 'identity')
+            return web.Response(body=b'{"name": "token"}', content_type='application/json',
+                                headers={'Cache-Control': 'max-age=60'})
+
+        url = await self.start_server('get', '/metadata.json', metadata)
+        mock_get_chain_info.return_value = (['http://example.com'], '2718')
+        mock_get_token_uri.return_value = f'{url}/metadata.json'
+
+        status, headers, body = await call_asgi('/GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'{"name": "token"}')
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(headers[b"cache-control"], b"max-age=60")
+
+    @patch('app.STREAM_PROXY', True)
+    @patch('app.get_chain_info')
+    @patch('asgi.get_token_uri_async', new_callable=AsyncMock)
+    async def test_handle_request_streams_encoded_url_content(self, mock_get_token_uri, mock_get_chain_info):
+        async def metadata(request):
+            # An upstream ignoring Accept-Encoding: identity
+            return web.Response(body=gzip.compress(b'{"name": "token"}'), content_type='application/json',
+                                headers={'Content-Encoding': 'gzip'})
+
+        url = await self.start_server('get', '/metadata.json', metadata)
+        mock_get_chain_info.return_value = (['http://example.com'], '2718')
+        mock_get_token_uri.return_value = f'{url}/metadata.json'
+
+        status, headers, body = await call_asgi('/GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'{"name": "token"}')
+        self.assertEqual(headers[b"content-length"], str(len(body)).encode())
+        self.assertNotIn(b"content-encoding", headers)
+
+    @patch('app.STREAM_PROXY', True)
+    @patch('app.MAX_PROXY_BODY_SIZE', 16)
+    @patch('app.get_chain_info')
+    @patch('asgi.get_token_uri_async', new_callable=AsyncMock)
+    async def test_handle_request_streamed_content_too_large_without_length(self, mock_get_token_uri, mock_get_chain_info):
+        async def video(request):
+            response = web.StreamResponse(headers={'Content-Type': 'video/mp4'})
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            for _ in range(3):
+                await response.write(b'x' * 10)
+            await response.write_eof()
+            return response
+
+        url = await self.start_server('get', '/video.mp4', video)
+        mock_get_chain_info.return_value = (['http://example.com'], '2718')
+        mock_get_token_uri.return_value = f'{url}/video.mp4'
+
+        # Refused before the status is sent, not cut short after a 200
+        status, headers, body = await call_asgi('/GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0xfffffffffffffffffffffffe000000000000007b)/GeneralKey(789)')
+        self.assertEqual(status, 502)
+
+    async def start_server(self, method, path, handler):
+        server_app = web.Application()
+        server_app.router.add_route(method, path, handler)
+        runner = web.AppRunner(server_app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.addAsyncCleanup(runner.cleanup)
+        return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    async def test_single_flight_shares_result(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def operation():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        results = await asyncio.gather(*[flight.do('key', operation) for _ in range(5)])
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    @patch('app.ADMIN_TOKEN', 'secret')
+    async def test_single_flight_reported(self):
+        async def operation():
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        def coalesced():
+            return REGISTRY.get_sample_value('gateway_single_flight_calls_total',
+                                             {'flight': 'content', 'outcome': 'coalesced'}) or 0
+
+        _, _, body = await call_asgi('/admin/status', headers=ADMIN_HEADERS)
+        before = json.loads(body)["coalescing"]["content"]["coalesced"]
+        before_metric = coalesced()
+        await asyncio.gather(*[content_flight.do('key', operation) for _ in range(5)])
+
+        _, _, body = await call_asgi('/admin/status', headers=ADMIN_HEADERS)
+        self.assertEqual(json.loads(body)["coalescing"]["content"]["coalesced"], before + 4)
+        self.assertEqual(coalesced(), before_metric + 4)
+
+    async def test_caches_accessed_off_the_loop(self):
+        loop_thread = threading.get_ident()
+        threads = []
+        get = gateway.ipfs_cache.get
+
+        def record_get(cid):
+            threads.append(threading.get_ident())
+            return get(cid)
+
+        gateway.ipfs_cache.put('someCID', {'data': 'some data'})
+        with patch.object(gateway.ipfs_cache, 'get', side_effect=record_get):
+            session = await application.get_session()
+            self.assertEqual(await get_ipfs_content_async(session, 'ipfs://someCID'), {'data': 'some data'})
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+
+    async def test_resolve_token_uri_async(self):
+        gateway._rpc_clients.clear()
+
+        async def rpc(request):
+            body = await request.json()
+            token_id = int(body["params"][0]["data"][10:], 16)
+            if token_id == 0:
+                return web.json_response({"jsonrpc": "2.0", "id": body["id"], "error": {"code": 3, "message": "execution reverted"}})
+            result = '0x' + encode_abi(['string'], [f'ipfs://token{token_id}']).hex()
+            return web.json_response({"jsonrpc": "2.0", "id": body["id"], "result": result})
+
+        rpc_url = await self.start_server('post', '/', rpc)
+        contract_address = '0xfffffffffffffffffffffffe000000000000007b'
+
+        session = await application.get_session()
+        self.assertEqual(await get_token_uri_async(session, [rpc_url], contract_address, '5'), 'ipfs://token5')
+        self.assertIsNone(await get_token_uri_async(session, [rpc_url], contract_address, '0'))
+        # Both outcomes are cached
+        self.assertEqual(gateway.token_uri_cache.stats()["misses"], 2)
+        await get_token_uri_async(session, [rpc_url], contract_address, '5')
+        await get_token_uri_async(session, [rpc_url], contract_address, '0')
+        self.assertEqual(gateway.token_uri_cache.stats()["hits"], 1)
+        self.assertEqual(gateway.token_uri_cache.stats()["negativeHits"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from benchmark import *
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_scenario(self):
+        scenario = next(scenario for scenario in SCENARIOS if scenario.name == 'failing-first-rpc')
+        result = run_scenario(scenario, requests=20, concurrency=4)
+        self.assertEqual(result["requests"], 20)
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["rps"], 0)
+        self.assertLessEqual(result["p50Ms"], result["p99Ms"])
+        self.assertGreater(result["peakRssKb"], 0)
+
+    def test_run_scenario_asgi(self):
+        scenario = next(scenario for scenario in SCENARIOS if scenario.name == 'cold-key')
+        result = run_scenario(scenario, requests=20, concurrency=4, target='asgi')
+        self.assertEqual(result["requests"], 20)
+        self.assertEqual(result["errors"], 0)
+        self.assertLessEqual(result["p50Ms"], result["p99Ms"])
+
+    def test_compare_to_baseline(self):
+        baseline = {"cold-key": {"requests": 100, "errors": 0, "rps": 100.0, "p50Ms": 10.0, "p99Ms": 50.0, "peakRssKb": 1000}}
+        result = dict(baseline["cold-key"], rps=90.0, p99Ms=55.0)
+        self.assertEqual(compare_to_baseline({"cold-key": result}, baseline, tolerance=0.25), [])
+
+        result = dict(baseline["cold-key"], rps=50.0, errors=1)
+        regressions = compare_to_baseline({"cold-key": result, "hot-key": result}, baseline, tolerance=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(regression.startswith("cold-key") for regression in regressions))
+
+
+if __name__ == '__main__':
+    unittest.main()
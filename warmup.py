@@ -0,0 +1,70 @@
+"""
+Warm up the caches for the tokens of a contract before they are requested:
+
+    $ python warmup.py --chain KLAOS --contract 0x... --from-token-id 1 --to-token-id 1000
+    $ python warmup.py --location 'GlobalConsensus(3)/Parachain(3336)/PalletInstance(51)/AccountKey20(0x...)' --from-block 1000000
+
+The tokenURIs are resolved and the IPFS contents fetched by this process, so only the
+caches it shares with the gateway are warmed: the SQLite tier of the IPFS cache on the same
+host and, with TOKEN_URI_CACHE_REDIS_URL, the tokenURI cache. To warm the in-process caches
+of a running gateway, use its POST /admin/warmup endpoint instead.
+"""
+import argparse
+import sys
+
+from werkzeug.exceptions import HTTPException
+
+import app as gateway
+
+
+def print_progress(job):
+    stats = job.stats()
+    done = stats["resolved"] + stats["notFound"] + stats["failed"]
+    print(f"{done}/{stats['tokens']} tokens: {stats['resolved']} resolved, {stats['notFound']} not found, "
+          f"{stats['failed']} failed; {stats['contentFetched']} contents fetched, "
+          f"{stats['contentFailed']} failed, {stats['contentSkipped']} not on IPFS", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-resolve the tokenURIs and IPFS contents of a contract's tokens.")
+    parser.add_argument('--location', help="Universal location prefix down to AccountKey20.")
+    parser.add_argument('--chain', help="Name or ChainId of the chain entry, with --contract.")
+    parser.add_argument('--contract', help="Contract address, with --chain.")
+    parser.add_argument('--token-ids', help="Comma-separated token IDs.")
+    parser.add_argument('--from-token-id', type=int, help="First token ID of an inclusive range.")
+    parser.add_argument('--to-token-id', type=int, help="Last token ID of an inclusive range.")
+    parser.add_argument('--from-block', type=int, help="First block of the Transfer logs to scan for token IDs.")
+    parser.add_argument('--to-block', type=int, help="Last block of the Transfer logs to scan (default: latest).")
+    parser.add_argument('--concurrency', type=int, default=gateway.WARMUP_DEFAULT_CONCURRENCY,
+                        help="Maximum number of content fetches in flight.")
+    parser.add_argument('--rpc-rate', type=float, default=gateway.WARMUP_DEFAULT_RPC_RATE,
+                        help="Maximum number of eth_calls per second.")
+    parser.add_argument('--content-rate', type=float, default=gateway.WARMUP_DEFAULT_CONTENT_RATE,
+                        help="Maximum number of content fetches per second.")
+    args = parser.parse_args(argv)
+
+    body = {"concurrency": args.concurrency, "rpcRate": args.rpc_rate, "contentRate": args.content_rate}
+    if args.location:
+        body["location"] = args.location
+    else:
+        body["chain"], body["contract"] = args.chain, args.contract
+    if args.token_ids:
+        body["tokenIds"] = [token_id.strip() for token_id in args.token_ids.split(',') if token_id.strip()]
+    elif args.from_token_id is not None:
+        body["fromTokenId"], body["toTokenId"] = args.from_token_id, args.to_token_id
+    elif args.from_block is not None:
+        body["fromBlock"], body["toBlock"] = args.from_block, args.to_block
+
+    try:
+        job = gateway.parse_warmup_request(body)
+    except HTTPException as e:
+        parser.error(e.description)
+    job.run(on_progress=print_progress)
+    if job.state != 'done':
+        print(f"Warm-up {job.state}: {job.error}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())